@@ -16,7 +16,6 @@
 
 #### imports ####
 from __future__ import print_function
-import logging as Logging
 import requests
 import typing
 
@@ -24,6 +23,9 @@ Any = typing.Any
 Union = typing.Union
 
 from .constants import Constants
+from .device_logging import device_name, get_logger
+from .governor import get_governor
+from .collection_cache import CollectionCache
 
 ##############################################################################
 #
@@ -35,9 +37,10 @@ class AepCommissioning():
     def __init__(self, options: Any):
         self.options = options
         self.session = requests.Session()
-        self.url = "https://{options.address}/api/".format(options=options)
+        self.url = "https://{options.address}:{options.api_port}/api/".format(options=options)
         self.token = None
-        self.logger = Logging.getLogger(__name__)
+        self.cache = CollectionCache()
+        self.logger = get_logger(__name__, device_name(options))
         pass
 
     class Error(Exception):
@@ -48,9 +51,10 @@ class AepCommissioning():
         logger = self.logger
         try:
             logger.debug("%s: GET %s", description, url)
-            response = self.session.get(url, verify=False)
-            response.raise_for_status()
-            result = response.json()
+            with get_governor().hold("sockets"):
+                response = self.session.get(url, verify=False)
+                response.raise_for_status()
+                result = response.json()
             logger.debug("%s GET response: %s", description, result)
         except requests.exceptions.RequestException as error:
             logger.debug("%s error: %s", description, error)
@@ -62,9 +66,10 @@ class AepCommissioning():
         logger = self.logger
         try:
             logger.debug("%s: POST %s", description, url)
-            response = self.session.post(url, verify=False, json=data)
-            response.raise_for_status()
-            result = response.json()
+            with get_governor().hold("sockets"):
+                response = self.session.post(url, verify=False, json=data)
+                response.raise_for_status()
+                result = response.json()
             logger.debug("%s: POST result: %s", description, result)
         except requests.exceptions.RequestException as error:
             logger.debug("%s POST error: %s", description, error)
@@ -76,9 +81,10 @@ class AepCommissioning():
         logger = self.logger
         try:
             logger.debug("%s: PUT %s", description, url)
-            response = self.session.put(url, verify=False, json=data)
-            response.raise_for_status()
-            result = response.json()
+            with get_governor().hold("sockets"):
+                response = self.session.put(url, verify=False, json=data)
+                response.raise_for_status()
+                result = response.json()
             logger.debug("%s: PUT response: %s", description, result)
         except requests.exceptions.RequestException as error:
             logger.debug("%s PUT error: %s", description, error)
@@ -86,17 +92,32 @@ class AepCommissioning():
 
         return result
 
+    def close(self) -> None:
+        """ close pooled connections; the session can still be used later """
+        self.session.close()
+
     def get_api_url_no_token(self, param: str) -> str:
         return f"{self.url}{param}"
 
     def get_api_url_with_token(self, param: str) -> str:
         return f"{self.url}{param}?token={self.token}"
 
-    def get_collection(self, param: str) -> Union[typing.Dict, None]:
+    def get_collection(self, param: str, /, refresh: bool = True) -> Union[typing.Dict, None]:
+        """
+        get a collection named param. If refresh is False and we have
+        a snapshot, return the snapshot without talking to the device.
+        """
+        if not refresh:
+            result = self.cache.get(param)
+            if result != None:
+                self.logger.debug("get collection %s: using snapshot", param)
+                return result
+
         url = self.get_api_url_with_token(param)
 
         result = self._do_get("get collection", url=url)
         if 'result' in result:
+            self.cache.put(param, result['result'])
             return result['result']
         return None
 
@@ -106,6 +127,42 @@ class AepCommissioning():
         result = self._do_put(f"set collection {param}", url=url, data=newValue)
         return result
 
+    def update_collection(self, param: str, newValue: dict) -> Union[typing.Dict, None]:
+        """
+        Update a collection named param, sending only the fields that
+        differ from the snapshot. Each changed top-level member is PUT
+        to its own sub-path, with only the changed fields in the body.
+
+        Returns the changes that were sent (an empty dict if nothing
+        needed to be sent), or None on error. If we don't have a
+        snapshot, falls back to sending the whole collection.
+        """
+        snapshot = self.cache.get(param)
+        if snapshot == None:
+            result = self.set_collection(param, newValue)
+            if 'error' in result:
+                return None
+            self.cache.put(param, newValue)
+            return newValue
+
+        changes = CollectionCache.diff(snapshot, newValue)
+        if not changes:
+            self.logger.debug("update collection %s: no changes", param)
+            return changes
+
+        for key, value in changes.items():
+            if isinstance(value, dict):
+                result = self.set_collection(f"{param}/{key}", value)
+            else:
+                result = self.set_collection(param, { key: value })
+            if 'error' in result:
+                # we don't know what state the device is in.
+                self.cache.invalidate()
+                return None
+
+        self.cache.update(param, changes)
+        return changes
+
     def command(self, command: str, /, data:Any=None) -> Union[typing.Dict, None]:
         """ execute a command named 'command' """
         url = self.get_api_url_with_token(f"command/{command}")
@@ -122,6 +179,8 @@ class AepCommissioning():
     #### specific AEP commands
     def revert(self):
         self.logger.info("revert gateway state to saved")
+        # the system facts can't be changed by a revert.
+        self.cache.invalidate(keep=("system",))
         return self.command("revert")
 
     def remoteAccess(self, /, data: Any = None) -> Union[typing.Dict, None]:
@@ -129,13 +188,13 @@ class AepCommissioning():
             self.logger.info("get remoteAccess collection")
             return self.get_collection("remoteAccess")
         else:
-            self.logger.info("set remoteAccess collection")
-            return self.set_collection("remoteAccess", newValue=data)
+            self.logger.info("update remoteAccess collection")
+            return self.update_collection("remoteAccess", newValue=data)
 
-    def systemObject(self, /, data: Union[typing.Dict, None] = None) -> Union[typing.Dict, None]:
+    def systemObject(self, /, data: Union[typing.Dict, None] = None, refresh: bool = False) -> Union[typing.Dict, None]:
         if data == None:
             self.logger.info("get system collection")
-            return self.get_collection("system")
+            return self.get_collection("system", refresh=refresh)
         else:
             self.logger.info("set system collection")
             return self.set_collection("system", newValue=data)
@@ -146,6 +205,8 @@ class AepCommissioning():
 
     def restart(self):
         self.logger.info("reboot gateway (this takes a while)")
+        # the system facts survive the reboot; nothing else is trusted.
+        self.cache.invalidate(keep=("system",))
         return self.command("restart")
 
     # login does not use token, so is special, calls _do_get()
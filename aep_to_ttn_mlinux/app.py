@@ -16,9 +16,11 @@
 #### imports ####
 from __future__ import print_function
 import argparse
-import logging
+import json
+import os
 import pathlib
 import sys
+import threading
 import time
 import typing
 import urllib3
@@ -30,6 +32,16 @@ from .constants import Constants
 from .__version__ import __version__
 from .aep_commissioning import AepCommissioning
 from .conduit_ssh import ConduitSsh
+from .ssh_tuning import SshProfileStore, SshTuner
+from .device_logging import DeviceLogging, device_name, get_logger
+from .image_repository import ImageRepository
+from .image_compression import ImageCompression
+from .inventory import Inventory
+from .distributed import Agent, Coordinator, JobQueue
+from .events import get_event_bus
+from .dashboard import Dashboard, DashboardLogHandler
+from .governor import get_governor
+from .wave import RebootWatcher
 
 ##############################################################################
 #
@@ -38,27 +50,48 @@ from .conduit_ssh import ConduitSsh
 ##############################################################################
 
 class App():
-    def __init__(self):
+    def __init__(self, /, options: Any = None, argv: Union[typing.List[str], None] = None):
         # load the constants
         self.constants = Constants()
 
         # configure urllib3
         urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
-        # now parse the args
-        options = self._parse_arguments()
+        # now parse the args (from argv if given, else the command line),
+        # unless we were given them (e.g., when running several devices
+        # in one process).
+        self.dashboard = None
+        self.events = get_event_bus()
+        if options == None:
+            options = self._parse_arguments(argv)
+            if options.dashboard:
+                self.dashboard = Dashboard(self.events)
+            get_governor().configure({
+                "sockets": options.max_sockets,
+                "ssh": options.max_ssh,
+                "image_bytes": options.max_image_memory * 1024 * 1024,
+                }, max_threads=options.max_threads)
         self.args = options
+        self.timings = {}
+        self.restart_pending = False
 
-        logging.basicConfig()
-        logger = logging.getLogger(__name__)
-        #logger.handlers = []
-        #logger.addHandler(logging.StreamHandler())
         if options.debug:
-            logger.setLevel('DEBUG')
+            level = 'DEBUG'
         elif options.verbose:
-            logger.setLevel('INFO')
+            level = 'INFO'
         else:
-            logger.setLevel('WARNING')
+            level = 'WARNING'
+
+        # only the first App in the process sets up logging.
+        DeviceLogging.setup(
+            app_logger=__name__,
+            app_level=level,
+            log_dir=options.log_dir,
+            console_rate=options.console_rate,
+            # on a terminal, the dashboard shows the warnings and errors.
+            console=DashboardLogHandler(self.dashboard) if self.dashboard != None and self.dashboard.tty else None
+            )
+        logger = get_logger(__name__, device_name(options))
 
         self.logger = logger
 
@@ -78,6 +111,13 @@ class App():
     def _initialize(self):
         self.aep = AepCommissioning(self.args)
         self.ssh = ConduitSsh(self.args)
+        self.ssh_profiles = SshProfileStore(self.args.ssh_profiles)
+        self.images = ImageRepository(
+                        self.args.image_repository,
+                        base_url=self.args.image_base_url,
+                        keep=self.args.keep_images
+                        )
+        self.compression = ImageCompression(self.args.compression_cache)
         pass
 
     ##########################################################################
@@ -86,7 +126,7 @@ class App():
     #
     ##########################################################################
 
-    def _parse_arguments(self):
+    def _parse_arguments(self, argv: Union[typing.List[str], None] = None):
         parser = argparse.ArgumentParser(
             prog="aep_to_ttn_mlinux",
             description=
@@ -128,6 +168,27 @@ class App():
                         dest="noop", default=False,
                         action='store_true',
                         help="Don't make changes, just list what we are going to do.")
+        group.add_argument("--dashboard",
+                        dest="dashboard", default=False,
+                        action='store_true',
+                        help="""
+                        Show a live view of every device in flight. On a terminal, this replaces
+                        the console log (use --log-dir to keep the details); otherwise, print a
+                        summary line periodically.
+                        """
+                        )
+        group.add_argument("--log-dir",
+                        dest="log_dir", default=None,
+                        help="Also write a complete log for each device to a file in this directory."
+                        )
+        group.add_argument("--console-rate",
+                        dest="console_rate", default=Constants.DEFAULT_CONSOLE_RATE,
+                        type=float,
+                        help="""
+                        Maximum informational console lines per second (default %(default)s);
+                        warnings and errors are always shown. Use 0 for no limit.
+                        """
+                        )
         parser.add_argument(
                         "--version",
                         action='version',
@@ -141,11 +202,25 @@ class App():
                         dest="username", default=Constants.DEFAULT_AEP_USERNAME,
                         help="Username to use to connect (default %(default)s).")
         group.add_argument("--password", "--pass", "-P",
-                        dest="password", required=True,
-                        help="Password to use to connect. There is no default; this must always be supplied.")
+                        dest="password", default=None,
+                        help="Password to use to connect. There is no default; this must always be supplied (except with --fetch-images or --coordinator).")
         group.add_argument("--address", "-A",
                         dest="address", default=Constants.DEFAULT_IP,
                         help="IP address of the conduit being commissioned (default %(default)s).")
+        group.add_argument("--api-port",
+                        dest="api_port", default=Constants.DEFAULT_API_PORT,
+                        type=int,
+                        help="Port of the commissioning API (default %(default)s)."
+                        )
+        group.add_argument("--ssh-port",
+                        dest="ssh_port", default=Constants.DEFAULT_SSH_PORT,
+                        type=int,
+                        help="Port to use for ssh connections (default %(default)s)."
+                        )
+        group.add_argument("--device-name",
+                        dest="device_name", default=None,
+                        help="Name used for this Conduit in log messages and log file names (default: the address)."
+                        )
         group.add_argument("-f", "--force",
                         dest="force", default=False,
                         action='store_true',
@@ -171,8 +246,24 @@ class App():
                         )
         # https://ttni.tech/mlinux/images/mtcdt/5.3.31/ttni-base-image-mtcdt-upgrade.bin
         group.add_argument("--image",
-                        dest="image_file", default=Constants.DEFAULT_MLINUX_IMAGE_PATTERN,
-                        help="Path to mLinux image to be downloaded; use {product_type} to insert the product type dynamically. (Default: %(default)s)"
+                        dest="image_file", default=None,
+                        help=f"""
+                        Path to mLinux image to be downloaded; use {{product_type}} to insert the product type dynamically.
+                        (Default: the image for --image-version from the image repository if present, otherwise
+                        {Constants.DEFAULT_MLINUX_IMAGE_PATTERN})
+                        """
+                        )
+        group.add_argument("--compress",
+                        dest="compress", default="auto",
+                        choices=("auto", "raw") + ImageCompression.METHODS,
+                        help="""
+                        How to upload the image (default %(default)s). "auto" compresses with the best
+                        method the Conduit can decompress, unless the image doesn't compress well.
+                        """
+                        )
+        group.add_argument("--compression-cache",
+                        dest="compression_cache", default=Constants.DEFAULT_COMPRESSION_CACHE,
+                        help="File of measured image compression ratios (default %(default)s)."
                         )
         group.add_argument("--reboot_time",
                         dest="reboot_time", default=Constants.DEFAULT_AEP_REBOOT_TIME_MAX,
@@ -181,12 +272,164 @@ class App():
                         help="How long to wait for reboots, in seconds (default %(default)s)."
                         )
 
-        options = parser.parse_args()
+        #	Image repository
+        group = parser.add_argument_group("Image repository options")
+        group.add_argument("--fetch-images",
+                        dest="fetch_images", default=None,
+                        metavar="PRODUCT_TYPES",
+                        help="""
+                        Don't configure a Conduit; instead fetch (or refresh) the images for the
+                        comma-separated product types (e.g., mtcdt,mtcap) into the image repository.
+                        """
+                        )
+        group.add_argument("--image-version",
+                        dest="image_version", default=Constants.DEFAULT_MLINUX_IMAGE_VERSION,
+                        help="mLinux version to fetch and use from the image repository (default %(default)s)."
+                        )
+        group.add_argument("--image-repository",
+                        dest="image_repository", default=Constants.DEFAULT_IMAGE_REPOSITORY,
+                        help="Directory for the image repository (default %(default)s)."
+                        )
+        group.add_argument("--image-base-url",
+                        dest="image_base_url", default=Constants.DEFAULT_IMAGE_BASE_URL,
+                        help="Where to fetch images from (default %(default)s)."
+                        )
+        group.add_argument("--keep-images",
+                        dest="keep_images", default=Constants.DEFAULT_IMAGE_KEEP,
+                        type=int,
+                        help="How many versions of the image for each product type to keep (default %(default)s)."
+                        )
+
+        #	Distributed provisioning
+        group = parser.add_argument_group("Distributed provisioning options")
+        group.add_argument("--coordinator",
+                        dest="coordinator", default=None,
+                        metavar="INVENTORY",
+                        help="""
+                        Don't configure a Conduit; instead hand out the gateways in the INVENTORY
+                        file to agents (see --agent), and wait for them all to finish.
+                        """
+                        )
+        group.add_argument("--listen",
+                        dest="listen", default=f"{Constants.DEFAULT_COORDINATOR_HOST}:{Constants.DEFAULT_COORDINATOR_PORT}",
+                        type=self._host_port,
+                        metavar="[HOST]:PORT",
+                        help="""
+                        Where the coordinator listens (default %(default)s, which only this host can
+                        reach; use e.g. 0.0.0.0:8327 to serve agents on other stations).
+                        """
+                        )
+        group.add_argument("--token",
+                        dest="token", default=os.environ.get(Constants.COORDINATOR_TOKEN_ENV),
+                        help=f"""
+                        Shared secret that the coordinator requires from its agents (default: the
+                        {Constants.COORDINATOR_TOKEN_ENV} environment variable). Required with
+                        --coordinator and --agent.
+                        """
+                        )
+        group.add_argument("--lease-time",
+                        dest="lease_time", default=Constants.DEFAULT_LEASE_TIME,
+                        type=float,
+                        help="""
+                        Seconds an agent may go without renewing a job before the coordinator
+                        gives the job to another agent (default %(default)s).
+                        """
+                        )
+        group.add_argument("--results",
+                        dest="results", default=None,
+                        help="Coordinator or wave: write the results and timings for each gateway to this JSON file."
+                        )
+        group.add_argument("--agent",
+                        dest="agent", default=None,
+                        metavar="URL",
+                        help="""
+                        Configure the gateways that the coordinator at URL (e.g., http://host:8327)
+                        assigns to this station.
+                        """
+                        )
+        group.add_argument("--station",
+                        dest="station", default=None,
+                        help="Agent: name of this station, as used in the inventory (default: the host name)."
+                        )
+        group.add_argument("--slots",
+                        dest="slots", default=1,
+                        type=int,
+                        help="Agent: how many gateways to configure at once (default %(default)s)."
+                        )
+        group.add_argument("--wave",
+                        dest="wave", default=None,
+                        metavar="INVENTORY",
+                        help="""
+                        Configure every gateway in the INVENTORY file from this station, as one
+                        wave: commission them all, restart them all together, then update each
+                        one as it comes back (see --max-threads).
+                        """
+                        )
+
+        #	Resource limits
+        group = parser.add_argument_group("Resource limits (for many gateways at once)")
+        group.add_argument("--max-sockets",
+                        dest="max_sockets", default=Constants.DEFAULT_MAX_SOCKETS,
+                        type=int,
+                        help="Most commissioning API requests in flight at once (default %(default)s)."
+                        )
+        group.add_argument("--max-ssh",
+                        dest="max_ssh", default=Constants.DEFAULT_MAX_SSH,
+                        type=int,
+                        help="Most ssh connections open at once (default %(default)s)."
+                        )
+        group.add_argument("--max-threads",
+                        dest="max_threads", default=Constants.DEFAULT_MAX_THREADS,
+                        type=int,
+                        help="Most gateways being worked on at once (default %(default)s)."
+                        )
+        group.add_argument("--max-image-memory",
+                        dest="max_image_memory", default=Constants.DEFAULT_MAX_IMAGE_MEMORY // (1024 * 1024),
+                        type=int,
+                        metavar="MB",
+                        help="Most memory used for image uploads at once, in megabytes (default %(default)s)."
+                        )
+
+        #	SSH tuning
+        group = parser.add_argument_group("SSH tuning options")
+        group.add_argument("--tune-ssh",
+                        dest="tune_ssh", default=False,
+                        action='store_true',
+                        help="""
+                        Instead of downloading the image, benchmark ssh transport settings
+                        against the Conduit and save the fastest for its product type and firmware.
+                        """
+                        )
+        group.add_argument("--ssh-profiles",
+                        dest="ssh_profiles", default=Constants.DEFAULT_SSH_PROFILE_PATH,
+                        help="File of tuned ssh profiles (default %(default)s)."
+                        )
+        group.add_argument("--no-ssh-profile",
+                        dest="use_ssh_profile", default=True,
+                        action='store_false',
+                        help="Ignore tuned ssh profiles, and use the default ssh settings."
+                        )
+
+        options = parser.parse_args(argv)
+        if options.password == None and options.fetch_images == None and options.coordinator == None:
+            parser.error("--password is required")
+        if (options.coordinator != None or options.agent != None) and not options.token:
+            parser.error(f"--token (or {Constants.COORDINATOR_TOKEN_ENV}) is required with --coordinator and --agent")
+        if options.keep_images < 1:
+            parser.error("--keep-images must be at least 1")
         if options.debug:
             options.verbose = options.debug
 
         return options
 
+    @staticmethod
+    def _host_port(value: str) -> typing.Tuple[str, int]:
+        """ parse [HOST]:PORT for argparse """
+        host, colon, port = value.rpartition(":")
+        if not colon or not port.isdigit() or not 0 < int(port) < 65536:
+            raise argparse.ArgumentTypeError(f"expected [HOST]:PORT, with a port from 1 to 65535: {value!r}")
+        return host, int(port)
+
     # return True if ssh needs to be changed
     def need_ssh_change(self, remoteAccess: dict) -> bool:
         ssh = remoteAccess['ssh']
@@ -256,36 +499,26 @@ class App():
         logger.info("username and password successfully set")
         return True
 
-    #######################################################
-    # Enable SSH (assuming username and password are set) #
-    #######################################################
-    def enable_ssh(self) -> bool:
+    ####################################################
+    # Get the system facts, and check the product type #
+    ####################################################
+    def get_system_facts(self) -> Union[dict, None]:
         aep = self.aep
         options = self.args
         logger = self.logger
 
-        if not aep.login():
-            return False
-
-        # restore to previous save
-        result = aep.revert()
-
-        if not result:
-            logger.error("revert failed")
-            return False
-
-        # get the system properties
+        # the system facts don't change, so a snapshot is fine.
         systemObject = aep.systemObject()
         if not systemObject:
             logger.error("could not read system object")
-            return False
+            return None
 
         logger.debug("system: %s", systemObject)
 
         # get the product ID
         if not "productId" in systemObject:
             logger.error("no systemObject.productId")
-            return False
+            return None
 
         # extract the major/minor parts
         productId = systemObject["productId"].casefold()
@@ -299,7 +532,7 @@ class App():
             options.product_type = productType # in case of case folding
         else:
             logger.error("product_type doesn't match: %s != %s", options.product_type, productType)
-            return False
+            return None
 
         if options.product_id == None:
             logger.debug("options.product_id set to %s", productId)
@@ -308,9 +541,33 @@ class App():
             options.product_id = productId # in case of case folding
         else:
             logger.error("product_id doesn't match: %s != %s", options.product_id, productId)
+            return None
+
+        return systemObject
+
+    #######################################################
+    # Enable SSH (assuming username and password are set) #
+    #######################################################
+    def enable_ssh(self, /, defer_restart: bool = False) -> bool:
+        """
+        Enable ssh, then restart the Conduit and wait for ssh to go down.
+        If defer_restart, leave the restart to the caller (who will find
+        restart_pending set if one is needed).
+        """
+        aep = self.aep
+        options = self.args
+        logger = self.logger
+
+        if not aep.login():
+            return False
+
+        systemObject = self.get_system_facts()
+        if not systemObject:
             return False
 
-        # get the remote access state
+        self.select_ssh_profile(systemObject)
+
+        # get the live remote access state
         remoteAccess = aep.remoteAccess()
         if not remoteAccess:
             logger.error("could not read remoteAccess object")
@@ -318,6 +575,26 @@ class App():
 
         logger.debug("remoteAccess: %s", remoteAccess)
 
+        # fast path: nothing to change, so don't revert, save or reboot.
+        # This reads the candidate config, which may hold unsaved changes
+        # (e.g., from a run that died before the restart), so only trust
+        # it if ssh actually answers.
+        if not self.need_ssh_change(remoteAccess) and not options.force and self.ssh.ping():
+            logger.info("ssh already enabled")
+            return True
+
+        # restore to previous save, and re-read what that gave us.
+        result = aep.revert()
+
+        if not result:
+            logger.error("revert failed")
+            return False
+
+        remoteAccess = aep.remoteAccess()
+        if not remoteAccess:
+            logger.error("could not read remoteAccess object")
+            return False
+
         sshChangeNeeded = self.need_ssh_change(remoteAccess)
 
         if not sshChangeNeeded:
@@ -333,30 +610,27 @@ class App():
             remoteAccess['ssh']['port'] = 22
 
             if not options.noop:
-                result = aep.remoteAccess(remoteAccess)
-                if result == None:
+                # only the changed fields are sent
+                changes = aep.remoteAccess(remoteAccess)
+                if changes == None:
                     logger.error("failed to set ssh in remoteAccess")
                     return False
 
-                result = aep.save()
-                if result == None:
-                    logger.error("failed to save state")
-                    return False
+                # don't write flash if nothing changed (i.e., --force)
+                if changes:
+                    result = aep.save()
+                    if result == None:
+                        logger.error("failed to save state")
+                        return False
+                else:
+                    logger.info("remoteAccess unchanged, skipping save")
 
-                result = aep.restart()
-                if result == None:
-                    logger.error("failed to trigger a reboot")
-                    return False
+                self.restart_pending = True
+                if defer_restart:
+                    return True
 
-                # wait for ping to fail
-                nPings = 1
-                while True:
-                    if not self.ssh.ping():
-                        break
-                    time.sleep(1)
-                    nPings += 1
-
-                logger.info("ssh unavailable on ping {ping}".format(ping=nPings))
+                if not self.restart_gateway():
+                    return False
 
             else:
                 logger.info("skipping update of remoteAccess")
@@ -364,34 +638,246 @@ class App():
         # Success!
         return True
 
+    ########################################################
+    # Restart the Conduit (to apply the saved ssh setting) #
+    ########################################################
+    def restart_gateway(self, /, wait: bool = True) -> bool:
+        logger = self.logger
+
+        result = self.aep.restart()
+        if result == None:
+            logger.error("failed to trigger a reboot")
+            return False
+        self.restart_pending = False
+
+        if not wait:
+            return True
+
+        # wait for ping to fail
+        nPings = 1
+        while True:
+            if not self.ssh.ping():
+                break
+            time.sleep(1)
+            nPings += 1
+
+        logger.info("ssh unavailable on ping {ping}".format(ping=nPings))
+        return True
+
+    ###################################################
+    # Use the tuned ssh profile for this kind of device #
+    ###################################################
+    def select_ssh_profile(self, systemObject: dict) -> None:
+        options = self.args
+        if not options.use_ssh_profile:
+            return
+
+        firmware = systemObject.get("firmware", "unknown")
+        profile = self.ssh_profiles.lookup(options.product_type, firmware)
+        if profile != None:
+            self.ssh.apply_profile(profile)
+        else:
+            self.logger.debug("no ssh profile for %s", SshProfileStore.key(options.product_type, firmware))
+
+    ##########################################
+    # Benchmark ssh and save the best result #
+    ##########################################
+    def tune_ssh(self) -> bool:
+        options = self.args
+        logger = self.logger
+
+        systemObject = self.get_system_facts()
+        if not systemObject:
+            return False
+        firmware = systemObject.get("firmware", "unknown")
+
+        if options.noop:
+            logger.info("skipping ssh tuning for %s", SshProfileStore.key(options.product_type, firmware))
+            return True
+
+        tuner = SshTuner(options, sample=SshTuner.get_sample(self.image_path()))
+        profile = tuner.tune()
+        if profile == None:
+            return False
+
+        self.ssh_profiles.store(options.product_type, firmware, profile)
+        self.ssh.apply_profile(profile)
+        logger.info("saved ssh profile for %s in %s", SshProfileStore.key(options.product_type, firmware), self.ssh_profiles.path)
+        return True
+
+    #################################
+    # Figure out which image to use #
+    #################################
+    def image_path(self) -> pathlib.Path:
+        options = self.args
+        if options.image_file != None:
+            return pathlib.Path(options.image_file.format(product_type=options.product_type))
+
+        path = self.images.resolve(options.product_type, options.image_version, touch=not options.noop)
+        if path != None:
+            return path
+
+        return pathlib.Path(Constants.DEFAULT_MLINUX_IMAGE_PATTERN.format(product_type=options.product_type))
+
+    ##################################################
+    # Fetch images into the repository, concurrently #
+    ##################################################
+    def fetch_images(self) -> bool:
+        options = self.args
+        product_types = [ t.strip().casefold() for t in options.fetch_images.split(",") if t.strip() != "" ]
+        if len(product_types) == 0:
+            self.logger.error("no product types given to --fetch-images")
+            return False
+
+        if options.noop:
+            for product_type in product_types:
+                self.logger.info("skipping fetch of %s", self.images.url(product_type, options.image_version))
+            return True
+
+        return self.images.fetch_all(product_types, options.image_version, jobs=len(product_types))
+
+    #######################################
+    # Check the Conduit before the upload #
+    #######################################
+    def preflight(self, infile: pathlib.Path, md5: str) -> Union[dict, None]:
+        """
+        Check free space, any existing image, the firmware version and
+        the upgrade tool, all in one round trip. Returns a dict of facts
+        (including "uploaded", True if the image is already there), or
+        None if the upload should not be attempted.
+        """
+        logger = self.logger
+        remote = Constants.REMOTE_FIRMWARE_PATH
+
+        probe = self.ssh.probe({
+            "tmp_free": "df -k /tmp | tail -n 1",
+            "image_md5": f"test -f {remote} && md5sum {remote}",
+            "image_size": f"test -f {remote} && wc -c < {remote}",
+            "firmware_version": "cat /etc/mlinux-version",
+            "upgrade_tool": f"test -x {Constants.FIRMWARE_UPGRADE_TOOL}",
+            "has_gzip": "command -v gunzip",
+            "has_zstd": "command -v zstd",
+            })
+        if probe == None:
+            return None
+
+        if probe["firmware_version"]["status"] == 0:
+            logger.info("Conduit firmware: %s", probe["firmware_version"]["output"].strip())
+
+        if probe["upgrade_tool"]["status"] != 0:
+            logger.error("%s not found on the Conduit", Constants.FIRMWARE_UPGRADE_TOOL)
+            return None
+
+        existing = 0
+        if probe["image_size"]["status"] == 0:
+            existing = int(probe["image_size"]["output"].strip())
+            if probe["image_md5"]["status"] == 0 and probe["image_md5"]["output"].split()[0:1] == [ md5 ]:
+                logger.info("%s already matches %s", remote, infile)
+                return { "uploaded": True }
+
+        # columns are filesystem, size, used, available, use%, mount
+        try:
+            available = int(probe["tmp_free"]["output"].split()[-3]) * 1024
+        except (IndexError, ValueError):
+            logger.error("can't parse free space in /tmp: %s", probe["tmp_free"]["output"])
+            return None
+
+        # the existing image is overwritten, so its space counts as free.
+        needed = infile.stat().st_size + Constants.REMOTE_TMP_HEADROOM
+        if available + existing < needed:
+            logger.error("not enough space in /tmp on the Conduit: %d bytes available, %d needed", available + existing, needed)
+            return None
+
+        decompressors = [
+            method for method in ImageCompression.METHODS if probe[f"has_{method}"]["status"] == 0
+            ]
+        return { "uploaded": False, "decompressors": decompressors }
+
+    ######################################
+    # Check the Conduit after the upload #
+    ######################################
+    def postcheck(self, infile: pathlib.Path, md5: str) -> bool:
+        logger = self.logger
+        remote = Constants.REMOTE_FIRMWARE_PATH
+
+        probe = self.ssh.probe({
+            "image_size": f"wc -c < {remote}",
+            "image_md5": f"md5sum {remote}",
+            })
+        if probe == None:
+            return False
+
+        size = infile.stat().st_size
+        if probe["image_size"]["status"] != 0 or probe["image_size"]["output"].strip() != str(size):
+            logger.error("uploaded image has the wrong size: %s (expected %d)", probe["image_size"]["output"], size)
+            return False
+        if probe["image_md5"]["status"] != 0 or probe["image_md5"]["output"].split()[0:1] != [ md5 ]:
+            logger.error("uploaded image has the wrong md5: %s (expected %s)", probe["image_md5"]["output"], md5)
+            return False
+
+        logger.info("uploaded image verified")
+        return True
+
     # copy image to Conduit
     def copy_image(self) -> bool:
-        c = self.ssh.connection
         options = self.args
-        infile = pathlib.Path(options.image_file.format(product_type=options.product_type))
+        infile = self.image_path()
         logger = self.logger
 
         if not infile.exists():
             logger.error("image_file not found: %s", infile)
+            return False
 
         if options.noop:
             return True
 
-        try:
-            logger.info("put image file: %s", infile)
-            _ = c.put(infile, remote="/tmp/firmware.bin")
-        except Exception as error:
-            logger.error("failed to put image file: {error}".format(error=error))
+        md5 = ImageCompression.image_md5(infile)
+        state = self.preflight(infile, md5)
+        if state == None:
             return False
+        if state["uploaded"]:
+            logger.info("skipping upload")
+            return True
 
-        return True
+        # the upload buffers count against the image memory limit
+        with get_governor().hold("image_bytes", amount=Constants.UPLOAD_BUFFER_BYTES):
+            return self._upload_image(infile, md5, state["decompressors"])
+
+    def _upload_image(self, infile: pathlib.Path, md5: str, decompressors: typing.List[str]) -> bool:
+        c = self.ssh.connection
+        options = self.args
+        logger = self.logger
+
+        method = self.compression.choose(infile, md5, decompressors, requested=options.compress)
+        if method != None:
+            logger.info("put image file: %s (%s)", infile, method)
+            compressed_size = int(infile.stat().st_size * self.compression.ratios(infile, md5)[method])
+            if not self.ssh.put_stream(
+                        ImageCompression.compressed_chunks(infile, method),
+                        f"{ImageCompression.DECOMPRESS_COMMAND[method]} > {Constants.REMOTE_FIRMWARE_PATH}",
+                        progress=lambda done: self.publish_progress("copy_image", done, compressed_size)
+                        ):
+                return False
+        else:
+            try:
+                logger.info("put image file: %s", infile)
+                _ = c.sftp().put(
+                        str(infile),
+                        Constants.REMOTE_FIRMWARE_PATH,
+                        callback=lambda done, total: self.publish_progress("copy_image", done, total)
+                        )
+            except Exception as error:
+                logger.error("failed to put image file: {error}".format(error=error))
+                return False
+
+        return self.postcheck(infile, md5)
 
     # apply image
     def apply_image(self) -> bool:
         self.logger.info("apply_image: start the firmware update")
         return self.ssh.sudo(
-                    "/usr/sbin/mlinux-firmware-upgrade /tmp/firmware.bin",
-                    echo=True
+                    f"{Constants.FIRMWARE_UPGRADE_TOOL} {Constants.REMOTE_FIRMWARE_PATH}",
+                    hide=True
                     )
 
     ################################
@@ -416,41 +902,269 @@ class App():
         logger = self.logger
 
         begin = time.time()
+        lastReport = begin
         while time.time() - begin < self.args.reboot_time:
-            print('.', end='', flush=True)
             if c.ping():
-                print()
                 logger.info("ssh available after {t} seconds".format(t=time.time() - begin))
                 return True
             time.sleep(1)
+            if time.time() - lastReport >= Constants.SSH_WAIT_REPORT_INTERVAL:
+                lastReport = time.time()
+                logger.info("still waiting for ssh after %d seconds", lastReport - begin)
         return False
 
-    #################################
-    # Run the app and return status #
-    #################################
-    def run(self) -> int:
-        aep = self.aep
-        options = self.args
-        logger = self.logger
+    ##############################################
+    # Run one stage, and record how long it took #
+    ##############################################
+    def run_stage(self, name: str, stage: typing.Callable[[], bool]) -> bool:
+        device = device_name(self.args)
+        self.events.publish(device, "stage", stage=name, state="start")
+        begin = time.monotonic()
+        ok = False
+        try:
+            ok = stage()
+            return ok
+        finally:
+            self.timings[name] = time.monotonic() - begin
+            self.events.publish(device, "stage", stage=name, state="end", ok=ok)
 
-        if not options.nopass:
-            if not self.set_password():
-                return 1
+    def publish_progress(self, stage: str, done: int, total: int) -> None:
+        self.events.publish(device_name(self.args), "progress", stage=stage, done=done, total=total)
 
-        if not self.enable_ssh():
+    #######################################################
+    # Run all the stages for one device and return status #
+    #######################################################
+    def run_device(self) -> int:
+        device = device_name(self.args)
+        self.events.publish(device, "device", state="start")
+        status = self._run_device()
+        self.events.publish(device, "device", state="end", status=status)
+        return status
+
+    def _run_device(self) -> int:
+        if not self.commission():
             return 1
+        return 0 if self.update_device() else 1
+
+    def commission(self, /, defer_restart: bool = False) -> bool:
+        """ the commissioning API steps: set the password, and enable ssh """
+        options = self.args
+
+        try:
+            if not options.nopass:
+                if not self.run_stage("set_password", self.set_password):
+                    return False
 
+            return self.run_stage("enable_ssh", lambda: self.enable_ssh(defer_restart=defer_restart))
+        finally:
+            # we're done with the API for now; don't keep its sockets.
+            self.aep.close()
+
+    def update_device(self) -> bool:
+        """ the ssh steps: wait for ssh, then copy and apply the image """
+        options = self.args
+        logger = self.logger
+
+        # wait for ssh outside the session: each ping holds an ssh slot
+        # only while it runs, so gateways that are still rebooting don't
+        # starve the ones that are ready to upload.
         if not self.check_ssh_enabled():
             logger.info("AEP is rebooting to enable SSH; wait until SSH comes up. This takes a few minutes (normally two to three)")
-            if not self.await_ssh_available(options.reboot_time):
-                return 1
+            if not self.run_stage("await_ssh", lambda: self.await_ssh_available(options.reboot_time)):
+                return False
+
+        # one connection for the checks, the upload and the update.
+        with self.ssh.session():
+            if not options.tune_ssh:
+                # copy the image
+                if not self.run_stage("copy_image", self.copy_image):
+                    return False
+
+                # apply the image
+                if not self.run_stage("apply_image", self.apply_image):
+                    return False
+
+        # benchmark instead of updating (this makes its own connections)
+        if options.tune_ssh:
+            return self.run_stage("tune_ssh", self.tune_ssh)
+
+        return True
+
+    #####################################################
+    # Run one inventory device (for agents and batches) #
+    #####################################################
+    def run_inventory_device(self, device: dict) -> dict:
+        app = App(options=Inventory.device_options(self.args, device))
+        status = app.run_device()
+        return { "status": status, "timings": app.timings }
+
+    ###########################################################
+    # Configure an inventory in one wave, overlapping reboots #
+    ###########################################################
+    def run_wave(self) -> int:
+        options = self.args
+        logger = self.logger
+        try:
+            inventory = Inventory.load(options.wave)
+        except Inventory.Error as error:
+            logger.error("%s", error)
+            return 1
+
+        apps = [ App(options=Inventory.device_options(options, device)) for device in inventory.devices ]
+        statuses: typing.Dict[str, int] = {}
+        restarted: typing.Dict[str, float] = {}
+        finished = threading.Condition()
+        governor = get_governor()
+        watcher = RebootWatcher()
+
+        def finish(app: App, status: int) -> None:
+            name = device_name(app.args)
+            self.events.publish(name, "device", state="end", status=status)
+            with finished:
+                statuses[name] = status
+                finished.notify_all()
+
+        def run(app: App, step: typing.Callable[[], bool]) -> bool:
+            try:
+                return step()
+            except Exception as error:
+                app.logger.error("wave step failed", exc_info=error)
+                return False
+
+        def commission(app: App) -> bool:
+            self.events.publish(device_name(app.args), "device", state="start")
+            if not run(app, lambda: app.commission(defer_restart=True)):
+                finish(app, 1)
+                return False
+            return True
+
+        def update(app: App) -> None:
+            finish(app, 0 if run(app, app.update_device) else 1)
 
-        # copy the image
-        if not self.copy_image():
+        def back(app: App, ok: bool) -> None:
+            # called by the watcher
+            name = device_name(app.args)
+            app.timings["await_ssh"] = time.monotonic() - restarted[name]
+            self.events.publish(name, "stage", stage="await_ssh", state="end", ok=ok)
+            if ok:
+                pool.submit(update, app)
+            else:
+                app.logger.error("not back after %d seconds", app.args.reboot_time)
+                finish(app, 1)
+
+        def restart(app: App) -> None:
+            # the settings don't say whether the old sshd is running, so
+            # look: if it is, the watcher must see it go down first.
+            was_up = run(app, lambda: watcher.answers(app.args.address, app.args.ssh_port))
+            ok = run(app, lambda: app.run_stage("restart", lambda: app.restart_gateway(wait=False)))
+            app.aep.close()
+            if not ok:
+                finish(app, 1)
+                return
+            restarted[device_name(app.args)] = time.monotonic()
+            self.events.publish(device_name(app.args), "stage", stage="await_ssh", state="start")
+            watcher.watch(
+                app, app.args.address, app.args.ssh_port,
+                timeout=app.args.reboot_time, callback=back, was_up=was_up
+                )
+
+        begin = time.monotonic()
+        watcher.start()
+        try:
+            with governor.worker_pool(len(apps)) as pool:
+                # first, do all the API work, holding back the restarts.
+                commissioned = [ app for app, ok in zip(apps, pool.map(commission, apps)) if ok ]
+                rebooting = [ app for app in commissioned if app.restart_pending ]
+                ready = [ app for app in commissioned if not app.restart_pending ]
+                logger.info(
+                    "commissioned %d of %d gateways in %.1f seconds; restarting %d",
+                    len(commissioned), len(apps), time.monotonic() - begin, len(rebooting)
+                    )
+
+                # then restart them all together; the restarts are queued
+                # ahead of the updates of the gateways that don't need one.
+                for app in rebooting:
+                    pool.submit(restart, app)
+                for app in ready:
+                    pool.submit(update, app)
+
+                with finished:
+                    finished.wait_for(lambda: len(statuses) == len(apps))
+        finally:
+            watcher.stop()
+
+        failed = sorted(name for name, status in statuses.items() if status != 0)
+        logger.info("wave finished in %.1f seconds: %d succeeded, %d failed", time.monotonic() - begin, len(apps) - len(failed), len(failed))
+        if failed:
+            logger.error("failed: %s", ", ".join(failed))
+
+        if options.results != None:
+            results = {
+                "jobs": [
+                    { "name": device_name(app.args), "status": statuses[device_name(app.args)], "timings": app.timings }
+                    for app in apps
+                ],
+            }
+            with open(options.results, "w") as f:
+                json.dump(results, f, indent=4)
+
+        return 1 if failed else 0
+
+    #####################################
+    # Coordinate several station agents #
+    #####################################
+    def run_coordinator(self) -> int:
+        options = self.args
+        try:
+            inventory = Inventory.load(options.coordinator)
+        except Inventory.Error as error:
+            self.logger.error("%s", error)
             return 1
 
-        # apply the image
-        if not self.apply_image():
+        host, port = options.listen
+        queue = JobQueue(inventory.devices, lease_time=options.lease_time)
+        try:
+            coordinator = Coordinator(queue, token=options.token, host=host, port=port)
+        except OSError as error:
+            self.logger.error("can't listen on %s:%d: %s", host, port, error)
             return 1
+        summary = coordinator.run()
+
+        if options.results != None:
+            with open(options.results, "w") as f:
+                json.dump(summary, f, indent=4)
+
+        return 0 if summary["counts"].get("done", 0) == len(inventory.devices) else 1
+
+    #################################
+    # Run the app and return status #
+    #################################
+    def run(self) -> int:
+        if self.dashboard == None:
+            return self._run()
+
+        self.dashboard.start()
+        try:
+            return self._run()
+        finally:
+            self.dashboard.stop()
+
+    def _run(self) -> int:
+        options = self.args
+
+        if options.fetch_images != None:
+            return 0 if self.fetch_images() else 1
+
+        if options.coordinator != None:
+            return self.run_coordinator()
+
+        if options.agent != None:
+            return Agent(
+                        options.agent, self.run_inventory_device,
+                        token=options.token, station=options.station, slots=options.slots
+                        ).run()
+
+        if options.wave != None:
+            return self.run_wave()
 
-        return 0
+        return self.run_device()
@@ -0,0 +1,102 @@
+##############################################################################
+#
+# Name: collection_cache.py
+#
+# Function:
+#       CollectionCache() class, keeps per-device snapshots of AEP
+#       collections so we can skip redundant reads and compute
+#       minimal writes.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import copy
+import typing
+
+Any = typing.Any
+Union = typing.Union
+
+##############################################################################
+#
+# The collection snapshot cache
+#
+##############################################################################
+
+class CollectionCache():
+    """
+    Snapshots of AEP collections for a single device.
+
+    Snapshots are deep copies, so callers can freely modify what they
+    get back and later hand it to diff() to find out what changed.
+    """
+    def __init__(self):
+        self.snapshots: typing.Dict[str, dict] = {}
+        pass
+
+    def get(self, name: str) -> Union[typing.Dict, None]:
+        """ return a copy of the snapshot of collection 'name', or None """
+        if name in self.snapshots:
+            return copy.deepcopy(self.snapshots[name])
+        return None
+
+    def put(self, name: str, value: dict) -> None:
+        """ record the current state of collection 'name' """
+        self.snapshots[name] = copy.deepcopy(value)
+
+    def update(self, name: str, changes: dict) -> None:
+        """ merge changes (as returned by diff()) into the snapshot """
+        if name not in self.snapshots:
+            return
+        self._merge(self.snapshots[name], copy.deepcopy(changes))
+
+    def invalidate(self, /, keep: typing.Iterable[str] = ()) -> None:
+        """ forget all snapshots, except those named in keep """
+        keep = set(keep)
+        for name in list(self.snapshots.keys()):
+            if name not in keep:
+                del self.snapshots[name]
+
+    @staticmethod
+    def diff(old: Any, new: Any) -> Union[typing.Dict, None]:
+        """
+        Return the minimal set of changes that turns old into new.
+
+        Dicts are compared key by key and recursively; anything else
+        (including lists) is treated as a single value. Keys that are
+        only present in old are ignored, because the AEP API has no way
+        to delete a field. Returns an empty dict if nothing changed.
+        """
+        if not isinstance(old, dict) or not isinstance(new, dict):
+            raise TypeError("diff() needs two dicts")
+
+        result = {}
+        for key, newValue in new.items():
+            if key not in old:
+                result[key] = copy.deepcopy(newValue)
+                continue
+            oldValue = old[key]
+            if isinstance(oldValue, dict) and isinstance(newValue, dict):
+                subDiff = CollectionCache.diff(oldValue, newValue)
+                if subDiff:
+                    result[key] = subDiff
+            elif oldValue != newValue or type(oldValue) != type(newValue):
+                result[key] = copy.deepcopy(newValue)
+
+        return result
+
+    @staticmethod
+    def _merge(target: dict, changes: dict) -> None:
+        for key, value in changes.items():
+            if isinstance(value, dict) and isinstance(target.get(key), dict):
+                CollectionCache._merge(target[key], value)
+            else:
+                target[key] = value
+
+### end of file ###
@@ -16,7 +16,9 @@
 
 #### imports ####
 from __future__ import print_function
-import logging as Logging
+import contextlib
+import json
+import re
 import typing
 
 Any = typing.Any
@@ -26,8 +28,11 @@ import warnings
 with warnings.catch_warnings():
    warnings.filterwarnings("ignore", message='.*cryptography')
    import fabric
+   import paramiko
 
 from .constants import Constants
+from .device_logging import device_name, get_logger
+from .governor import get_governor
 
 ##############################################################################
 #
@@ -36,18 +41,84 @@ from .constants import Constants
 ##############################################################################
 
 class ConduitSsh():
-    def __init__(self, options: Any):
+    # map profile keys to the paramiko algorithm lists they select from
+    PROFILE_ALGORITHMS = {
+        "cipher": ("ciphers", "_preferred_ciphers"),
+        "mac": ("macs", "_preferred_macs"),
+        "kex": ("kex", "_preferred_kex"),
+    }
+
+    def __init__(self, options: Any, /, profile: Union[typing.Dict, None] = None):
         self.options = options
-        self.connection = fabric.Connection(    
+        self.logger = get_logger(__name__, device_name(options))
+        self.profile = profile
+        self.depth = 0
+        self.connection = self._make_connection(profile)
+        pass
+
+    def _make_connection(self, profile: Union[typing.Dict, None]) -> fabric.Connection:
+        options = self.options
+        connect_kwargs = {
+            "password": options.password,
+            "timeout": Constants.DEFAULT_SSH_TIMEOUT
+        }
+
+        if profile:
+            if "timeout" in profile:
+                connect_kwargs["timeout"] = profile["timeout"]
+            if "compress" in profile:
+                connect_kwargs["compress"] = profile["compress"]
+
+            # paramiko has no "prefer" setting, so we disable everything
+            # else in the list to force the choice.
+            disabled_algorithms = {}
+            for key, (kind, attr) in self.PROFILE_ALGORITHMS.items():
+                choice = profile.get(key)
+                if choice:
+                    disabled_algorithms[kind] = [
+                        name for name in getattr(paramiko.Transport, attr) if name != choice
+                        ]
+            if disabled_algorithms:
+                connect_kwargs["disabled_algorithms"] = disabled_algorithms
+
+        return fabric.Connection(
                             host=options.address,
+                            port=options.ssh_port,
                             user=options.username,
-                            connect_kwargs={
-                                "password": options.password,
-                                "timeout": 3
-                            }
+                            connect_kwargs=connect_kwargs
                             )
-        self.logger = Logging.getLogger(__name__)
-        pass
+
+    def apply_profile(self, profile: Union[typing.Dict, None]) -> None:
+        """ use a (tuned) transport profile for future connections """
+        self.logger.info("ssh profile: %s", profile)
+        self.connection.close()
+        self.profile = profile
+        self.connection = self._make_connection(profile)
+
+    @contextlib.contextmanager
+    def session(self) -> typing.Iterator[fabric.Connection]:
+        """
+        Keep the ssh connection for a group of operations. While held,
+        the connection counts against the governor's "ssh" limit; it's
+        closed when the outermost session ends. Sessions nest, but an
+        instance must only be used by one thread.
+        """
+        if self.depth == 0:
+            get_governor().acquire("ssh")
+        self.depth += 1
+        try:
+            yield self.connection
+        finally:
+            self.depth -= 1
+            if self.depth == 0:
+                self.connection.close()
+                get_governor().release("ssh")
+
+    @staticmethod
+    def available_algorithms(key: str) -> typing.Tuple[str, ...]:
+        """ return the algorithms paramiko supports for profile key """
+        _, attr = ConduitSsh.PROFILE_ALGORITHMS[key]
+        return tuple(getattr(paramiko.Transport, attr))
 
     class Error(Exception):
         """ this is the Exception thrown by class AepSsh """
@@ -56,31 +127,168 @@ class ConduitSsh():
     # return TRUE if we can reach via SSH
     def ping(self, /, timeout: Union[int, None]=None) -> bool:
         self.logger.info("ping ssh")
+
+        try:
+            self._ping(timeout)
+            return True
+        except Exception as error:
+            if not self._profile_rejected(error):
+                return False
+            # the Conduit answered, but not with the profile's algorithms
+            self.logger.warning("ssh profile %s failed (%s); retrying with the default settings", self.profile, error)
+
+        self.apply_profile(None)
+        try:
+            self._ping(timeout)
+            return True
+        except Exception:
+            return False
+
+    def _ping(self, timeout: Union[int, None]) -> None:
         connection = self.connection
 
         if timeout != None:
             connection.connect_timeout = timeout
 
-        try:
+        with self.session():
             _ = connection.run("echo ping", hide=True, timeout=5)
-            return True
-        except Exception as error:
-            return False
+
+    def _profile_rejected(self, error: Exception) -> bool:
+        """
+        True if error is the Conduit refusing our profile: we have one,
+        and the algorithm negotiation failed. Anything else (a refused
+        connection, or a banner or handshake error while the Conduit is
+        rebooting or busy) doesn't say the profile is wrong.
+        """
+        return bool(self.profile) and isinstance(error, paramiko.ssh_exception.IncompatiblePeer)
 
     def sudo(self, command: str, /, **sudo_kwargs) -> bool:
-        self.logger.info("sudo")
+        """
+        Run command with sudo. Its output goes to our logger, not to
+        stdout, unless the caller says otherwise with hide.
+        """
+        self.logger.info("sudo: %s", command)
         connection = self.connection
         options = self.options
+        sudo_kwargs.setdefault("hide", True)
 
         try:
-            result = connection.sudo(
-                    command, 
-                    password=options.password,
-                    dry=options.noop,
-                    **sudo_kwargs
-                    )
-            self.logger.debug("sudo results: %s", result)
+            with self.session():
+                result = connection.sudo(
+                        command,
+                        password=options.password,
+                        dry=options.noop,
+                        **sudo_kwargs
+                        )
+            self._log_output(result)
             return True
         except Exception as error:
+            self._log_output(getattr(error, "result", None))
             self.logger.error("sudo error", exc_info=error, stack_info=True)
             return False
+
+    def _log_output(self, result: Any) -> None:
+        """ log the output of a command, less sudo's password prompt """
+        if result == None:
+            return
+        prompt = self.connection.config.sudo.prompt.strip()
+        for stream in ("stdout", "stderr"):
+            for line in (getattr(result, stream, None) or "").splitlines():
+                line = line.replace(prompt, "").strip()
+                if line:
+                    self.logger.info("%s: %s", stream, line)
+
+    def put_stream(
+        self,
+        chunks: typing.Iterable[bytes],
+        command: str,
+        /,
+        timeout: int = 600,
+        progress: Union[typing.Callable[[int], None], None] = None
+        ) -> bool:
+        """
+        Run command on the Conduit, feeding chunks to its stdin, and
+        wait for it to finish. For example, with compressed chunks and
+        "gunzip -c > /tmp/firmware.bin", the image is decompressed on
+        the Conduit as part of the transfer. progress, if given, is
+        called with the number of bytes sent so far.
+        """
+        logger = self.logger
+        logger.info("put stream: %s", command)
+        try:
+            with self.session() as connection:
+                connection.open()
+                channel = connection.client.get_transport().open_session(timeout=timeout)
+                channel.settimeout(timeout)
+                channel.exec_command(command)
+                nBytes = 0
+                for chunk in chunks:
+                    channel.sendall(chunk)
+                    nBytes += len(chunk)
+                    if progress != None:
+                        progress(nBytes)
+                channel.shutdown_write()
+                status = channel.recv_exit_status()
+                errors = b""
+                while channel.recv_stderr_ready():
+                    errors += channel.recv_stderr(4096)
+                channel.close()
+        except Exception as error:
+            logger.error("put stream failed: %s", error)
+            return False
+
+        if status != 0:
+            logger.error("put stream: %s exited with status %d: %s", command, status, errors.decode(errors="replace").strip())
+            return False
+
+        logger.debug("put stream: sent %d bytes", nBytes)
+        return True
+
+    # shell function to turn stdin into the body of a JSON string
+    PROBE_ESCAPE = r"""_json() { tr -d '\000-\011\013-\037' | sed -e 's/\\/\\\\/g' -e 's/"/\\"/g' | awk 'BEGIN { ORS="" } NR > 1 { print "\\n" } { print }'; }"""
+
+    # shell to run one check and print its result
+    PROBE_CHECK = r"""_out=$( {{ {command} ; }} 2>&1 ); _rc=$?
+printf '%s"{name}":{{"status":%d,"output":"%s"}}' "$_sep" "$_rc" "$(printf '%s' "$_out" | _json)"
+_sep=','"""
+
+    @staticmethod
+    def probe_script(checks: typing.Dict[str, str]) -> str:
+        """
+        Return a shell script that runs each of checks (a dict mapping
+        name to shell command) and prints one JSON object mapping each
+        name to { "status": exit status, "output": stdout and stderr }.
+        Only the tools in a minimal busybox are needed.
+        """
+        lines = [ ConduitSsh.PROBE_ESCAPE, "printf '{'", "_sep=''" ]
+        for name, command in checks.items():
+            if not re.fullmatch(r"[A-Za-z_][A-Za-z0-9_]*", name):
+                raise ConduitSsh.Error(f"bad probe name: {name}")
+            lines.append(ConduitSsh.PROBE_CHECK.format(name=name, command=command))
+        lines.append(r"printf '}\n'")
+        return "\n".join(lines) + "\n"
+
+    def probe(self, checks: typing.Dict[str, str], /, timeout: int = 60) -> Union[typing.Dict, None]:
+        """
+        Run a bundle of checks on the Conduit in a single round trip.
+        Returns a dict mapping each check name to a dict with "status"
+        (the exit status) and "output", or None if the probe couldn't
+        be run at all.
+        """
+        logger = self.logger
+        logger.info("probe: %s", ", ".join(checks.keys()))
+        try:
+            with self.session() as connection:
+                result = connection.run(
+                            self.probe_script(checks),
+                            hide=True,
+                            warn=True,
+                            timeout=timeout
+                            )
+            probe = json.loads(result.stdout)
+        except Exception as error:
+            logger.error("probe failed: %s", error)
+            return None
+
+        logger.debug("probe results: %s", probe)
+        return probe
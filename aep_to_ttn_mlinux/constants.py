@@ -28,6 +28,85 @@ class Constants:
         # default image name
         DEFAULT_MLINUX_IMAGE_PATTERN = "/tmp/ttni-base-image-{product_type}-upgrade.bin"
 
+        # the managed image repository: where images come from, where we
+        # keep them, and how many versions of each to keep.
+        DEFAULT_IMAGE_BASE_URL = "https://ttni.tech/mlinux/images"
+        IMAGE_URL_PATTERN = "{base_url}/{product_type}/{version}/ttni-base-image-{product_type}-upgrade.bin"
+        DEFAULT_MLINUX_IMAGE_VERSION = "5.3.31"
+        DEFAULT_IMAGE_REPOSITORY = "~/.cache/aep_to_ttn_mlinux/images"
+        DEFAULT_IMAGE_KEEP = 3
+        IMAGE_FETCH_TIMEOUT = 60
+
         DEFAULT_AEP_USERNAME = "mtadm"
 
+        # where the image goes on the Conduit, and what installs it
+        REMOTE_FIRMWARE_PATH = "/tmp/firmware.bin"
+        FIRMWARE_UPGRADE_TOOL = "/usr/sbin/mlinux-firmware-upgrade"
+
+        # free space we want left in /tmp after the upload, in bytes
+        REMOTE_TMP_HEADROOM = 1024 * 1024
+
+        # compressed uploads: where measured compression ratios are kept,
+        # and the largest compressed/raw ratio that's worth compressing
+        DEFAULT_COMPRESSION_CACHE = "~/.cache/aep_to_ttn_mlinux/compression.json"
+        COMPRESSION_MAX_RATIO = 0.9
+
+        # default ssh connect timeout, in seconds, absent a tuned profile
+        DEFAULT_SSH_TIMEOUT = 3
+
+        # where tuned ssh transport profiles are kept
+        DEFAULT_SSH_PROFILE_PATH = "~/.config/aep_to_ttn_mlinux/ssh_profiles.json"
+
+        # how much data to upload for each ssh tuning trial, and how often
+        DEFAULT_SSH_TUNE_BYTES = 4 * 1024 * 1024
+        DEFAULT_SSH_TUNE_ROUNDS = 2
+
+        # how many informational lines per second we print on the console
+        DEFAULT_CONSOLE_RATE = 20
+
+        # dashboard: seconds between redraws on a terminal, and between
+        # summary lines otherwise
+        DASHBOARD_REFRESH = 0.5
+        DASHBOARD_SUMMARY_INTERVAL = 30
+
+        # how often to report that we're still waiting for ssh, in seconds
+        SSH_WAIT_REPORT_INTERVAL = 15
+
+        # distributed provisioning: where the coordinator listens (only
+        # on this host unless --listen says otherwise), the environment
+        # variable with the shared token, how long an agent holds a job
+        # without renewing it, how often a job is retried after its
+        # agent disappears, how often an idle agent asks for work, how
+        # many times an agent retries an unreachable coordinator, and
+        # how long the coordinator stays up after all the work is done
+        # (so agents hear that it's done).
+        DEFAULT_COORDINATOR_HOST = "127.0.0.1"
+        DEFAULT_COORDINATOR_PORT = 8327
+        COORDINATOR_TOKEN_ENV = "AEP_TO_TTN_MLINUX_TOKEN"
+        DEFAULT_LEASE_TIME = 120
+        DEFAULT_LEASE_ATTEMPTS = 3
+        AGENT_POLL_INTERVAL = 5
+        AGENT_MAX_RETRIES = 12
+        COORDINATOR_LINGER = 30
+
+        # resource governor defaults: concurrent API requests, open ssh
+        # connections, worker threads, and bytes of image data buffered
+        # for uploads (each upload is charged UPLOAD_BUFFER_BYTES, which
+        # covers our chunk plus the ssh window)
+        DEFAULT_MAX_SOCKETS = 256
+        DEFAULT_MAX_SSH = 128
+        DEFAULT_MAX_THREADS = 128
+        DEFAULT_MAX_IMAGE_MEMORY = 256 * 1024 * 1024
+        UPLOAD_BUFFER_BYTES = 4 * 1024 * 1024
+
+        # most per-device log files we keep open at once
+        MAX_OPEN_LOG_FILES = 64
+
+        # the ports the commissioning API and ssh listen on
+        DEFAULT_API_PORT = 443
+        DEFAULT_SSH_PORT = 22
+
+        # wave mode: seconds between checks of the rebooting gateways
+        REBOOT_WATCH_INTERVAL = 2
+
 ### end of file ###
@@ -0,0 +1,290 @@
+##############################################################################
+#
+# Name: dashboard.py
+#
+# Function:
+#       Dashboard() class: a live terminal view of every device in
+#       flight, fed by the event bus.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import logging as Logging
+import shutil
+import sys
+import threading
+import time
+import typing
+
+Any = typing.Any
+Union = typing.Union
+
+from .constants import Constants
+from .events import EventBus
+
+##############################################################################
+#
+# The dashboard
+#
+##############################################################################
+
+class Dashboard():
+    """
+    One row per device (stage, elapsed time, upload rate and ETA) plus
+    an aggregate line. Events only update a table; a background thread
+    renders at most every 'refresh' seconds, and only rewrites the rows
+    that changed, so the cost doesn't grow with the event rate.
+
+    If the stream isn't a terminal, the dashboard instead writes a
+    one-line summary every 'summary_interval' seconds.
+
+    Warnings and errors (see DashboardLogHandler) become the message of
+    the device's row. Those for no row (e.g., from the app itself) are
+    held and written after the final render, and once the dashboard is
+    stopped they're written directly.
+    """
+    HEADER = "{name:<20} {stage:<12} {elapsed:>8} {rate:>10} {eta:>8}  {message}"
+
+    def __init__(
+        self,
+        bus: EventBus,
+        /,
+        stream: Any = None,
+        tty: Union[bool, None] = None,
+        refresh: float = Constants.DASHBOARD_REFRESH,
+        summary_interval: float = Constants.DASHBOARD_SUMMARY_INTERVAL
+        ):
+        self.bus = bus
+        self.stream = stream if stream != None else sys.stderr
+        self.tty = tty if tty != None else self.stream.isatty()
+        self.interval = refresh if self.tty else summary_interval
+        self.lock = threading.Lock()
+        self.devices: typing.Dict[str, typing.Dict] = {}
+        self.started = time.monotonic()
+        self.previous: typing.List[str] = []
+        self.held: typing.List[str] = []
+        self.stopped = False
+        self.stopping = threading.Event()
+        self.thread = None
+        pass
+
+    #### event handling (publisher's thread)
+    def _device(self, name: str, now: float) -> dict:
+        device = self.devices.get(name)
+        if device == None:
+            device = {
+                "state": "running",
+                "stage": "",
+                "started": now,
+                "ended": None,
+                "done": 0,
+                "total": 0,
+                "upload_started": None,
+                "message": "",
+            }
+            self.devices[name] = device
+        return device
+
+    def on_event(self, event: dict) -> None:
+        now = event["time"]
+        kind = event["kind"]
+        with self.lock:
+            device = self._device(event["device"], now)
+            if kind == "stage" and event["state"] == "start":
+                device["stage"] = event["stage"]
+                device["done"] = device["total"] = 0
+                device["upload_started"] = None
+            elif kind == "progress":
+                if device["upload_started"] == None:
+                    device["upload_started"] = now
+                device["done"] = event["done"]
+                device["total"] = event["total"]
+            elif kind == "device" and event["state"] == "start":
+                device["started"] = now
+            elif kind == "device" and event["state"] == "end":
+                device["state"] = "done" if event["status"] == 0 else "failed"
+                device["stage"] = device["state"]
+                device["ended"] = now
+                device["upload_started"] = None
+
+    def log(self, device: Union[str, None], level: str, message: str, line: str) -> None:
+        """ show a warning or error in device's row, or hold line for later """
+        with self.lock:
+            if not self.stopped:
+                if device in self.devices:
+                    self.devices[device]["message"] = f"{level}: {message}"
+                else:
+                    self.held.append(line)
+                return
+        self.stream.write(line + "\n")
+        self.stream.flush()
+
+    #### rendering (dashboard thread)
+    @staticmethod
+    def _time(seconds: Union[float, None]) -> str:
+        if seconds == None:
+            return ""
+        seconds = int(seconds)
+        return f"{seconds // 60:d}:{seconds % 60:02d}"
+
+    @staticmethod
+    def _rate(rate: Union[float, None]) -> str:
+        if rate == None:
+            return ""
+        return f"{rate / 1e6:.2f}MB/s"
+
+    def _upload_rate(self, device: dict, now: float) -> Union[float, None]:
+        if device["upload_started"] == None or now <= device["upload_started"]:
+            return None
+        return device["done"] / (now - device["upload_started"])
+
+    def _snapshot(self, now: float) -> typing.Tuple[dict, typing.List[typing.Tuple[str, dict, Union[float, None]]]]:
+        counts = { "running": 0, "done": 0, "failed": 0 }
+        stages: typing.Dict[str, int] = {}
+        throughput = 0.0
+        rows = []
+        with self.lock:
+            for name, device in self.devices.items():
+                counts[device["state"]] += 1
+                rate = None
+                if device["state"] == "running":
+                    stages[device["stage"]] = stages.get(device["stage"], 0) + 1
+                    rate = self._upload_rate(device, now)
+                    if rate != None:
+                        throughput += rate
+                rows.append((name, dict(device), rate))
+        return { "counts": counts, "stages": stages, "throughput": throughput }, rows
+
+    def _summary_line(self, summary: dict, now: float) -> str:
+        counts = summary["counts"]
+        stages = ", ".join(f"{stage} {n}" for stage, n in sorted(summary["stages"].items()))
+        return (
+            f"{sum(counts.values())} devices: {counts['running']} running, "
+            f"{counts['done']} done, {counts['failed']} failed"
+            + (f" ({stages})" if stages else "")
+            + f"; uploading {self._rate(summary['throughput'])}; elapsed {self._time(now - self.started)}"
+            )
+
+    def _row(self, name: str, device: dict, rate: Union[float, None], now: float) -> str:
+        end = device["ended"] if device["ended"] != None else now
+        eta = None
+        if rate and device["total"] > device["done"]:
+            eta = (device["total"] - device["done"]) / rate
+        return self.HEADER.format(
+                    name=name[:20],
+                    stage=device["stage"][:12],
+                    elapsed=self._time(end - device["started"]),
+                    rate=self._rate(rate),
+                    eta=self._time(eta),
+                    message=device["message"]
+                    )
+
+    def _lines(self, now: float) -> typing.List[str]:
+        summary, rows = self._snapshot(now)
+        columns, lines = shutil.get_terminal_size()
+
+        # running devices first, then failures, then the rest
+        order = { "running": 0, "failed": 1, "done": 2 }
+        rows.sort(key=lambda row: (order[row[1]["state"]], row[1]["started"]))
+
+        result = [
+            self._summary_line(summary, now),
+            self.HEADER.format(name="device", stage="stage", elapsed="elapsed", rate="rate", eta="eta", message=""),
+            ]
+        room = max(1, lines - len(result) - 1)
+        if len(rows) > room:
+            hidden = len(rows) - (room - 1)
+            rows = rows[:room - 1]
+        else:
+            hidden = 0
+        result += [ self._row(name, device, rate, now) for name, device, rate in rows ]
+        if hidden:
+            result.append(f"... and {hidden} more")
+        return [ line[:columns - 1] for line in result ]
+
+    def render(self) -> None:
+        now = time.monotonic()
+        if not self.tty:
+            summary, _ = self._snapshot(now)
+            self.stream.write(self._summary_line(summary, now) + "\n")
+            self.stream.flush()
+            return
+
+        lines = self._lines(now)
+        previous = self.previous
+
+        # the region never shrinks; leftover rows are blanked.
+        if len(lines) < len(previous):
+            lines = lines + [ "" ] * (len(previous) - len(lines))
+
+        out = []
+        if previous:
+            out.append(f"\x1b[{len(previous)}A")
+        for i, line in enumerate(lines):
+            if i < len(previous) and previous[i] == line:
+                out.append("\n")
+            else:
+                out.append(f"\r{line}\x1b[K\n")
+        self.stream.write("".join(out))
+        self.stream.flush()
+        self.previous = lines
+
+    def _run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            self.render()
+
+    def start(self) -> None:
+        self.bus.subscribe(self.on_event)
+        self.thread = threading.Thread(target=self._run, name="dashboard", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread != None:
+            self.thread.join()
+        self.bus.unsubscribe(self.on_event)
+        self.render()
+        with self.lock:
+            self.stopped = True
+            held, self.held = self.held, []
+        for line in held:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+##############################################################################
+#
+# Warnings and errors go to the dashboard, not the console
+#
+##############################################################################
+
+class DashboardLogHandler(Logging.Handler):
+    """
+    A console replacement while the dashboard owns the terminal: each
+    warning or error becomes the device's message on the dashboard, or
+    is printed after it (see Dashboard.log()).
+    """
+    def __init__(self, dashboard: Dashboard):
+        super().__init__(Logging.WARNING)
+        self.dashboard = dashboard
+
+    def emit(self, record):
+        try:
+            device = getattr(record, "device", None)
+            message = record.getMessage()
+            self.dashboard.log(
+                    device,
+                    record.levelname,
+                    message,
+                    f"{record.levelname}:{device if device != None else '-'}:{record.name}:{message}"
+                    )
+        except Exception:
+            self.handleError(record)
+
+### end of file ###
@@ -0,0 +1,242 @@
+##############################################################################
+#
+# Name: device_logging.py
+#
+# Function:
+#       Per-device logging: contextual loggers that tag each record with
+#       the device, a queue so callers never block on output, per-device
+#       log files, and a rate-limited console.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import atexit
+import collections
+import logging as Logging
+import logging.handlers
+import pathlib
+import queue
+import re
+import sys
+import threading
+import time
+import typing
+
+Any = typing.Any
+Union = typing.Union
+
+from .constants import Constants
+
+##############################################################################
+#
+# Device-tagged loggers
+#
+##############################################################################
+
+class DeviceLoggerAdapter(Logging.LoggerAdapter):
+    """ a logger that tags every record with the device it's about """
+    def process(self, msg, kwargs):
+        extra = kwargs.get("extra", {})
+        extra["device"] = self.extra["device"]
+        kwargs["extra"] = extra
+        return msg, kwargs
+
+def device_name(options: Any) -> str:
+    """ the name we use for the device described by options """
+    name = getattr(options, "device_name", None)
+    return name if name else options.address
+
+def get_logger(name: str, device: str) -> DeviceLoggerAdapter:
+    """ get a logger for module 'name', tagged with device """
+    return DeviceLoggerAdapter(Logging.getLogger(name), { "device": device })
+
+##############################################################################
+#
+# Handlers (these run in the listener thread)
+#
+##############################################################################
+
+class _DefaultDeviceFilter(Logging.Filter):
+    """ make sure every record has a device attribute """
+    def filter(self, record):
+        if not hasattr(record, "device"):
+            record.device = "-"
+        return True
+
+class _ConsoleLevelFilter(Logging.Filter):
+    """
+    The app logger prints at the level chosen by -v/-d; everything else
+    only prints warnings and worse. (The files get everything.)
+    """
+    def __init__(self, app_logger: str, app_level: int):
+        super().__init__()
+        self.app_logger = app_logger
+        self.app_level = app_level
+
+    def filter(self, record):
+        if record.name == self.app_logger:
+            return record.levelno >= self.app_level
+        return record.levelno >= Logging.WARNING
+
+class DeviceFileHandler(Logging.Handler):
+    """
+    Write records to one file per device, opened on first use. Only the
+    most recently used max_open files are kept open; the others are
+    reopened (for append) when needed.
+    """
+    def __init__(self, log_dir: pathlib.Path, /, max_open: int = Constants.MAX_OPEN_LOG_FILES):
+        super().__init__()
+        self.log_dir = log_dir
+        self.max_open = max_open
+        self.files: typing.OrderedDict[str, Logging.FileHandler] = collections.OrderedDict()
+
+    @staticmethod
+    def _filename(device: str) -> str:
+        return re.sub(r"[^A-Za-z0-9_.-]", "_", device) + ".log"
+
+    def emit(self, record):
+        device = getattr(record, "device", "-")
+        handler = self.files.get(device)
+        if handler == None:
+            while len(self.files) >= self.max_open:
+                _, oldest = self.files.popitem(last=False)
+                oldest.close()
+            self.log_dir.mkdir(parents=True, exist_ok=True)
+            handler = Logging.FileHandler(self.log_dir / self._filename(device))
+            handler.setFormatter(self.formatter)
+            self.files[device] = handler
+        else:
+            self.files.move_to_end(device)
+        handler.handle(record)
+
+    def close(self):
+        for handler in self.files.values():
+            handler.close()
+        self.files = {}
+        super().close()
+
+class RateLimitedConsoleHandler(Logging.StreamHandler):
+    """
+    A console handler for many devices at once. Warnings and errors
+    always print; other records are limited to 'rate' per second (with
+    bursts up to 'rate'), and the ones we drop are counted per device
+    and reported once output is possible again.
+    """
+    def __init__(self, /, rate: float, stream: Any = None):
+        super().__init__(stream)
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.suppressed: typing.Dict[str, int] = {}
+
+    def _report_suppressed(self):
+        for device, count in self.suppressed.items():
+            self.stream.write(f"INFO:{device}:{count} message(s) not shown; see the device log\n")
+        self.suppressed = {}
+        self.flush()
+
+    def emit(self, record):
+        now = time.monotonic()
+        self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+        if record.levelno < Logging.WARNING:
+            if self.rate > 0 and self.tokens < 1:
+                device = getattr(record, "device", "-")
+                self.suppressed[device] = self.suppressed.get(device, 0) + 1
+                return
+            self.tokens -= 1
+
+        if self.suppressed:
+            self._report_suppressed()
+        super().emit(record)
+
+    def close(self):
+        if self.suppressed:
+            self._report_suppressed()
+        super().close()
+
+##############################################################################
+#
+# Process-wide setup
+#
+##############################################################################
+
+class DeviceLogging():
+    """
+    Process-wide logging setup. Loggers only put records on a queue;
+    a background listener formats them and writes the console and the
+    per-device files, so a slow terminal never holds up a device.
+    """
+    FORMAT = "%(levelname)s:%(device)s:%(name)s:%(message)s"
+    FILE_FORMAT = "%(asctime)s %(levelname)s:%(name)s:%(message)s"
+
+    _lock = threading.Lock()
+    _listener: Union[Logging.handlers.QueueListener, None] = None
+
+    @classmethod
+    def setup(
+        cls,
+        /,
+        app_logger: str,
+        app_level: Union[int, str],
+        log_dir: Union[str, None] = None,
+        console_rate: float = Constants.DEFAULT_CONSOLE_RATE,
+        console: Union[Logging.Handler, None] = None
+        ) -> None:
+        """
+        Set up logging, once per process; later calls do nothing. If
+        console is given, it replaces the usual console handler (e.g.,
+        when a dashboard owns the terminal).
+        """
+        with cls._lock:
+            if cls._listener != None:
+                return
+
+            Logging.getLogger(app_logger).setLevel(app_level)
+            app_level = Logging.getLogger(app_logger).getEffectiveLevel()
+
+            if console == None:
+                console = RateLimitedConsoleHandler(rate=console_rate, stream=sys.stderr)
+                console.setFormatter(Logging.Formatter(cls.FORMAT))
+                console.addFilter(_ConsoleLevelFilter(app_logger, app_level))
+            handlers = [ console ]
+
+            if log_dir != None:
+                files = DeviceFileHandler(pathlib.Path(log_dir).expanduser())
+                files.setFormatter(Logging.Formatter(cls.FILE_FORMAT))
+                handlers.append(files)
+                # the files get everything from this package.
+                Logging.getLogger(__package__).setLevel(Logging.DEBUG)
+                Logging.getLogger(app_logger).setLevel(Logging.DEBUG)
+
+            logQueue = queue.SimpleQueue()
+            queueHandler = Logging.handlers.QueueHandler(logQueue)
+            queueHandler.addFilter(_DefaultDeviceFilter())
+
+            root = Logging.getLogger()
+            root.handlers = [ queueHandler ]
+
+            cls._listener = Logging.handlers.QueueListener(logQueue, *handlers, respect_handler_level=True)
+            cls._listener.start()
+            atexit.register(cls.shutdown)
+
+    @classmethod
+    def shutdown(cls) -> None:
+        """ drain the queue and close the handlers """
+        with cls._lock:
+            listener = cls._listener
+            cls._listener = None
+        if listener != None:
+            listener.stop()
+            for handler in listener.handlers:
+                handler.close()
+
+### end of file ###
@@ -0,0 +1,408 @@
+##############################################################################
+#
+# Name: distributed.py
+#
+# Function:
+#       JobQueue(), Coordinator() and Agent() classes: spread the
+#       gateways in an inventory over several station PCs.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import hmac
+import http.server
+import json
+import logging as Logging
+import os
+import socket
+import threading
+import time
+import typing
+import requests
+
+Any = typing.Any
+Callable = typing.Callable
+Union = typing.Union
+
+from .constants import Constants
+from .governor import get_governor
+
+##############################################################################
+#
+# The job queue (lives in the coordinator)
+#
+##############################################################################
+
+class JobQueue():
+    """
+    One job per inventory device. A job is "queued" until an agent
+    leases it, then "leased" until the agent reports "done" or "failed".
+    An agent must renew its leases; if a lease expires (the agent died
+    or lost its network), the job goes back in the queue, up to
+    max_attempts times.
+
+    Leased jobs don't carry the device's secrets (SECRET_KEYS); agents
+    use their own --password.
+    """
+
+    # inventory keys that never leave the coordinator
+    SECRET_KEYS = ("password",)
+
+    def __init__(
+        self,
+        devices: typing.List[typing.Dict],
+        /,
+        lease_time: float = Constants.DEFAULT_LEASE_TIME,
+        max_attempts: int = Constants.DEFAULT_LEASE_ATTEMPTS
+        ):
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.logger = Logging.getLogger(__name__)
+        self.jobs = [
+            {
+                "id": i,
+                "device": device,
+                "state": "queued",
+                "agent": None,
+                "expires": None,
+                "attempts": 0,
+                "result": None,
+            }
+            for i, device in enumerate(devices)
+        ]
+
+    def _expire(self, now: float) -> None:
+        for job in self.jobs:
+            if job["state"] != "leased" or job["expires"] > now:
+                continue
+            name = job["device"]["name"]
+            if job["attempts"] >= self.max_attempts:
+                self.logger.error("%s: lease held by %s expired; giving up", name, job["agent"])
+                job["state"] = "failed"
+                job["result"] = { "status": None, "message": "lease expired" }
+            else:
+                self.logger.warning("%s: lease held by %s expired; re-queued", name, job["agent"])
+                job["state"] = "queued"
+                job["agent"] = None
+
+    def expire(self) -> None:
+        """ re-queue jobs whose leases have expired """
+        with self.lock:
+            self._expire(time.monotonic())
+
+    def lease(self, agent: str, station: str, count: int) -> typing.List[typing.Dict]:
+        """ lease up to count jobs to agent, for gateways at station """
+        now = time.monotonic()
+        result = []
+        with self.lock:
+            self._expire(now)
+            for job in self.jobs:
+                if len(result) >= count:
+                    break
+                if job["state"] != "queued":
+                    continue
+                if job["device"].get("station") not in (None, station):
+                    continue
+                job["state"] = "leased"
+                job["agent"] = agent
+                job["expires"] = now + self.lease_time
+                job["attempts"] += 1
+                result.append({ "id": job["id"], "device": self._public(job["device"]) })
+                self.logger.info("%s: leased to %s", job["device"]["name"], agent)
+        return result
+
+    def _public(self, device: dict) -> dict:
+        return { key: value for key, value in device.items() if key not in self.SECRET_KEYS }
+
+    def renew(self, agent: str, job_id: int) -> bool:
+        with self.lock:
+            job = self._find(job_id)
+            if job == None or job["state"] != "leased" or job["agent"] != agent:
+                return False
+            job["expires"] = time.monotonic() + self.lease_time
+            return True
+
+    def report(self, agent: str, job_id: int, result: dict) -> bool:
+        """ record the result of a job; ignored unless agent holds the lease """
+        with self.lock:
+            job = self._find(job_id)
+            if job == None or job["state"] != "leased" or job["agent"] != agent:
+                return False
+            job["state"] = "done" if result.get("status") == 0 else "failed"
+            job["result"] = result
+            self.logger.info("%s: %s by %s: %s", job["device"]["name"], job["state"], agent, result)
+            return True
+
+    def _find(self, job_id: int) -> Union[typing.Dict, None]:
+        if not isinstance(job_id, int) or job_id < 0 or job_id >= len(self.jobs):
+            return None
+        return self.jobs[job_id]
+
+    def finished(self) -> bool:
+        with self.lock:
+            return all(job["state"] in ("done", "failed") for job in self.jobs)
+
+    def summary(self) -> dict:
+        with self.lock:
+            counts = {}
+            for job in self.jobs:
+                counts[job["state"]] = counts.get(job["state"], 0) + 1
+            return {
+                "counts": counts,
+                "finished": all(job["state"] in ("done", "failed") for job in self.jobs),
+                "jobs": [
+                    {
+                        "name": job["device"]["name"],
+                        "state": job["state"],
+                        "agent": job["agent"],
+                        "attempts": job["attempts"],
+                        "result": job["result"],
+                    }
+                    for job in self.jobs
+                ],
+            }
+
+##############################################################################
+#
+# The coordinator: serves the job queue over HTTP
+#
+##############################################################################
+
+class _CoordinatorHandler(http.server.BaseHTTPRequestHandler):
+    """
+    POST /lease  { "agent", "station", "count" } -> { "jobs", "finished", "lease_time" }
+    POST /renew  { "agent", "job" }              -> { "ok" }
+    POST /report { "agent", "job", "result" }    -> { "ok" }
+    GET /status                                  -> the queue summary
+
+    Every request must carry "Authorization: Bearer <token>", with the
+    coordinator's shared token; anything else gets a 401.
+    """
+    def _reply(self, code: int, body: dict) -> None:
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _authorized(self) -> bool:
+        expected = f"Bearer {self.server.token}".encode("utf-8")
+        given = self.headers.get("Authorization", "").encode("utf-8")
+        if hmac.compare_digest(given, expected):
+            return True
+        self.server.logger.warning("%s: request without the coordinator token", self.address_string())
+        self._reply(401, { "error": "unauthorized" })
+        return False
+
+    def do_GET(self):
+        if not self._authorized():
+            return
+        if self.path == "/status":
+            self._reply(200, self.server.queue.summary())
+        else:
+            self._reply(404, { "error": "not found" })
+
+    def do_POST(self):
+        if not self._authorized():
+            return
+        queue = self.server.queue
+        try:
+            length = int(self.headers.get("Content-Length", "0"))
+            request = json.loads(self.rfile.read(length) or b"{}")
+            agent = str(request["agent"])
+            if self.path == "/lease":
+                jobs = queue.lease(agent, request.get("station"), int(request.get("count", 1)))
+                self._reply(200, { "jobs": jobs, "finished": queue.finished(), "lease_time": queue.lease_time })
+            elif self.path == "/renew":
+                self._reply(200, { "ok": queue.renew(agent, request["job"]) })
+            elif self.path == "/report":
+                self._reply(200, { "ok": queue.report(agent, request["job"], request["result"]) })
+            else:
+                self._reply(404, { "error": "not found" })
+        except (KeyError, TypeError, ValueError) as error:
+            self._reply(400, { "error": str(error) })
+
+    def log_message(self, format, *args):
+        self.server.logger.debug("%s: " + format, self.address_string(), *args)
+
+class Coordinator():
+    """ holds the inventory and the job queue, and hands out jobs to agents """
+    def __init__(
+        self,
+        queue: JobQueue,
+        /,
+        token: str,
+        host: str = Constants.DEFAULT_COORDINATOR_HOST,
+        port: int = Constants.DEFAULT_COORDINATOR_PORT,
+        linger: float = Constants.COORDINATOR_LINGER
+        ):
+        self.queue = queue
+        self.linger = linger
+        self.logger = Logging.getLogger(__name__)
+        self.server = http.server.ThreadingHTTPServer((host, port), _CoordinatorHandler)
+        self.server.daemon_threads = True
+        self.server.queue = queue
+        self.server.token = token
+        self.server.logger = self.logger
+        pass
+
+    @property
+    def address(self) -> typing.Tuple[str, int]:
+        return self.server.server_address[0:2]
+
+    def run(self) -> dict:
+        """ serve until every job is finished; returns the summary """
+        logger = self.logger
+        thread = threading.Thread(target=self.server.serve_forever, name="coordinator", daemon=True)
+        thread.start()
+        logger.info("coordinator listening on %s:%d with %d jobs", *self.address, len(self.queue.jobs))
+
+        try:
+            while not self.queue.finished():
+                time.sleep(1)
+                self.queue.expire()
+
+            # stay up a little, so idle agents hear that we're done.
+            logger.info("all jobs finished")
+            time.sleep(self.linger)
+        finally:
+            self.server.shutdown()
+            self.server.server_close()
+            thread.join()
+
+        summary = self.queue.summary()
+        for job in summary["jobs"]:
+            logger.info("%s: %s (agent %s, attempts %d): %s", job["name"], job["state"], job["agent"], job["attempts"], job["result"])
+        return summary
+
+##############################################################################
+#
+# The agent: leases jobs for gateways at this station, and runs them
+#
+##############################################################################
+
+class Agent():
+    """
+    Lease jobs from a coordinator and run them, up to 'slots' at a time.
+    runner(device) does the work for one inventory device and returns a
+    result dict, whose "status" is 0 for success. token is the
+    coordinator's shared token.
+    """
+    def __init__(
+        self,
+        url: str,
+        runner: Callable[[dict], dict],
+        /,
+        token: str,
+        station: Union[str, None] = None,
+        slots: int = 1,
+        poll_interval: float = Constants.AGENT_POLL_INTERVAL
+        ):
+        self.url = url.rstrip("/")
+        self.runner = runner
+        self.station = station if station else socket.gethostname()
+        self.name = f"{self.station}:{socket.gethostname()}:{os.getpid()}"
+        # no more leases than we have threads to run them
+        self.slots = max(1, min(slots, get_governor().max_threads))
+        self.poll_interval = poll_interval
+        self.lease_time = Constants.DEFAULT_LEASE_TIME
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {token}"
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.logger = Logging.getLogger(__name__)
+        pass
+
+    def _post(self, path: str, body: dict) -> dict:
+        body = dict(body, agent=self.name)
+        with self.lock:
+            response = self.session.post(f"{self.url}{path}", json=body, timeout=30)
+        response.raise_for_status()
+        return response.json()
+
+    def _run_job(self, job: dict) -> dict:
+        device = job["device"]
+        begin = time.monotonic()
+        try:
+            result = self.runner(device)
+        except Exception as error:
+            self.logger.error("%s: runner failed", device["name"], exc_info=error)
+            result = { "status": None, "message": str(error) }
+        result["elapsed"] = time.monotonic() - begin
+        result["station"] = self.station
+        self.wakeup.set()
+        return result
+
+    def _heartbeat(self, active: dict, stop: threading.Event) -> None:
+        while not stop.wait(max(1, self.lease_time / 3)):
+            for job_id in list(active.keys()):
+                try:
+                    if not self._post("/renew", { "job": job_id })["ok"]:
+                        self.logger.warning("lost the lease on job %d", job_id)
+                except requests.exceptions.RequestException as error:
+                    self.logger.warning("can't renew job %d: %s", job_id, error)
+
+    def run(self) -> int:
+        """ work until the coordinator is finished; returns exit status """
+        logger = self.logger
+        logger.info("agent %s: %d slot(s), coordinator %s", self.name, self.slots, self.url)
+
+        active = {}         # job id -> future
+        reports = []        # (job id, result) not yet delivered
+        failures = 0
+        status = 0
+        finished = False
+        stop = threading.Event()
+        heartbeat = threading.Thread(target=self._heartbeat, args=(active, stop), name="heartbeat", daemon=True)
+        heartbeat.start()
+
+        with get_governor().worker_pool(self.slots) as executor:
+            try:
+                while not (finished and not active and not reports):
+                    self.wakeup.clear()
+
+                    for job_id, future in list(active.items()):
+                        if future.done():
+                            del active[job_id]
+                            reports.append((job_id, future.result()))
+
+                    try:
+                        while reports:
+                            job_id, result = reports[0]
+                            if result.get("status") != 0:
+                                status = 1
+                            self._post("/report", { "job": job_id, "result": result })
+                            reports.pop(0)
+
+                        if not finished and len(active) < self.slots:
+                            reply = self._post("/lease", { "station": self.station, "count": self.slots - len(active) })
+                            self.lease_time = reply.get("lease_time", self.lease_time)
+                            finished = reply["finished"]
+                            for job in reply["jobs"]:
+                                logger.info("%s: starting", job["device"]["name"])
+                                active[job["id"]] = executor.submit(self._run_job, job)
+                        failures = 0
+                    except requests.exceptions.RequestException as error:
+                        failures += 1
+                        logger.warning("coordinator unreachable (%d): %s", failures, error)
+                        if failures >= Constants.AGENT_MAX_RETRIES and not active:
+                            logger.error("giving up on the coordinator")
+                            return 1
+
+                    self.wakeup.wait(self.poll_interval)
+            finally:
+                stop.set()
+
+        logger.info("agent %s: no more work", self.name)
+        return status
+
+### end of file ###
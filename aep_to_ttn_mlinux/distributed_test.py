@@ -0,0 +1,192 @@
+##############################################################################
+#
+# Name: distributed_test.py
+#
+# Function:
+#       Run a coordinator and several agent processes on this host, kill
+#       one agent while it holds a job, and check that the job is
+#       re-queued and finished by another agent.
+#
+#       python -m aep_to_ttn_mlinux.distributed_test
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import argparse
+import logging as Logging
+import secrets
+import subprocess
+import sys
+import threading
+import time
+import typing
+import requests
+
+Any = typing.Any
+
+from .distributed import Agent, Coordinator, JobQueue
+
+##############################################################################
+#
+# The agent process
+#
+##############################################################################
+
+def run_agent(options: Any) -> int:
+    """ an agent whose jobs just take a while; fails any job carrying secrets """
+    def runner(device: dict) -> dict:
+        leaked = [ key for key in JobQueue.SECRET_KEYS if key in device ]
+        if leaked:
+            return { "status": 1, "message": f"lease carried {', '.join(leaked)}" }
+        time.sleep(options.job_time)
+        return { "status": 0 }
+
+    Logging.basicConfig(level=Logging.WARNING)
+    return Agent(
+                options.agent, runner,
+                token=options.token, station=options.station, slots=options.slots,
+                poll_interval=DistributedTest.POLL_INTERVAL
+                ).run()
+
+##############################################################################
+#
+# The test (runs the coordinator in this process)
+#
+##############################################################################
+
+class DistributedTest():
+    """
+    Serve an inventory of DEVICES gateways with a short lease time.
+    Check that requests without the token are refused, then start an
+    agent whose jobs never end, kill it once it holds a lease, and start
+    AGENTS healthy agents. Passes if every job is done, the killed
+    agent's job was leased a second time, no lease carried a password,
+    and the healthy agents exit cleanly.
+    """
+    DEVICES = 6
+    AGENTS = 2
+    LEASE_TIME = 2
+    POLL_INTERVAL = 0.2
+    TIMEOUT = 60
+
+    def __init__(self, options: Any):
+        self.options = options
+        self.token = secrets.token_hex(16)
+        self.failures = []
+        pass
+
+    @staticmethod
+    def _parse_arguments() -> Any:
+        parser = argparse.ArgumentParser(
+            prog="aep_to_ttn_mlinux.distributed_test",
+            description="Check lease expiry and re-queueing with several local agent processes."
+            )
+        parser.add_argument("--agent", default=None,
+                        help=argparse.SUPPRESS)
+        parser.add_argument("--token", default=None,
+                        help=argparse.SUPPRESS)
+        parser.add_argument("--station", default="local",
+                        help=argparse.SUPPRESS)
+        parser.add_argument("--slots", type=int, default=1,
+                        help=argparse.SUPPRESS)
+        parser.add_argument("--job-time", dest="job_time", type=float, default=0.5,
+                        help=argparse.SUPPRESS)
+        return parser.parse_args()
+
+    def check(self, ok: bool, what: str) -> None:
+        print(f"{'ok' if ok else 'FAILED'}: {what}")
+        if not ok:
+            self.failures.append(what)
+
+    def _start_agent(self, url: str, /, station: str, slots: int, job_time: float) -> subprocess.Popen:
+        return subprocess.Popen([
+            sys.executable, "-m", "aep_to_ttn_mlinux.distributed_test",
+            "--agent", url, "--token", self.token,
+            "--station", station, "--slots", str(slots), "--job-time", str(job_time),
+            ])
+
+    def _await(self, condition: typing.Callable[[], bool]) -> bool:
+        deadline = time.monotonic() + self.TIMEOUT
+        while not condition():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+    def run(self) -> int:
+        devices = [
+            { "name": f"gw{i:02d}", "address": f"192.168.{i + 2}.1", "password": "not-for-agents" }
+            for i in range(self.DEVICES)
+        ]
+        queue = JobQueue(devices, lease_time=self.LEASE_TIME)
+        coordinator = Coordinator(queue, token=self.token, host="127.0.0.1", port=0, linger=2 * self.POLL_INTERVAL + 1)
+        url = "http://{}:{}".format(*coordinator.address)
+        summary = {}
+        server = threading.Thread(target=lambda: summary.update(coordinator.run()), name="coordinator", daemon=True)
+        server.start()
+
+        # no token, no jobs
+        reply = requests.post(f"{url}/lease", json={ "agent": "intruder", "count": self.DEVICES }, timeout=10)
+        self.check(reply.status_code == 401, "a lease request without the token is refused")
+        reply = requests.get(f"{url}/status", headers={ "Authorization": "Bearer wrong" }, timeout=10)
+        self.check(reply.status_code == 401, "a status request with the wrong token is refused")
+
+        # an agent that takes a job and dies with it
+        doomed = self._start_agent(url, station="doomed", slots=1, job_time=3600)
+        def doomed_job() -> typing.Union[dict, None]:
+            for job in queue.summary()["jobs"]:
+                if job["state"] == "leased" and job["agent"].startswith("doomed:"):
+                    return job
+            return None
+        self.check(self._await(lambda: doomed_job() != None), "the doomed agent leased a job")
+        lost = doomed_job()
+        doomed.kill()
+        doomed.wait()
+
+        agents = [ self._start_agent(url, station=f"bench-{i}", slots=2, job_time=0.5) for i in range(self.AGENTS) ]
+        server.join(self.TIMEOUT)
+        self.check(not server.is_alive(), "the coordinator finished")
+        statuses = []
+        for agent in agents:
+            try:
+                statuses.append(agent.wait(self.TIMEOUT))
+            except subprocess.TimeoutExpired:
+                agent.kill()
+                statuses.append(None)
+        self.check(statuses == [ 0 ] * self.AGENTS, f"the healthy agents exited cleanly: {statuses}")
+
+        if summary:
+            self.check(summary["counts"] == { "done": self.DEVICES }, f"every job is done: {summary['counts']}")
+            if lost != None:
+                job = next(job for job in summary["jobs"] if job["name"] == lost["name"])
+                self.check(
+                    job["attempts"] == 2 and job["state"] == "done" and job["agent"].startswith("bench-"),
+                    f"{lost['name']} was re-queued after its agent died, and done by {job['agent']}"
+                    )
+
+        print("PASS" if not self.failures else "FAIL")
+        return 0 if not self.failures else 1
+
+##############################################################################
+#
+# The main program
+#
+##############################################################################
+
+def main() -> int:
+    options = DistributedTest._parse_arguments()
+    if options.agent != None:
+        return run_agent(options)
+    return DistributedTest(options).run()
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+### end of file ###
@@ -0,0 +1,78 @@
+##############################################################################
+#
+# Name: events.py
+#
+# Function:
+#       EventBus() class: in-process publish/subscribe for progress
+#       events (stage changes, upload progress, messages).
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import logging as Logging
+import threading
+import time
+import typing
+
+Any = typing.Any
+Callable = typing.Callable
+Union = typing.Union
+
+##############################################################################
+#
+# The event bus
+#
+##############################################################################
+
+class EventBus():
+    """
+    Events are dicts with at least "device", "kind" and "time". The
+    kinds we publish are:
+
+        "stage"     stage, state ("start" or "end"), ok (at "end")
+        "progress"  stage, done and total (bytes)
+        "device"    state ("start" or "end"), status (at "end")
+
+    Subscribers are called in the publisher's thread, so they must be
+    quick; typically they just record the event.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers: typing.List[Callable[[dict], None]] = []
+        self.logger = Logging.getLogger(__name__)
+        pass
+
+    def subscribe(self, subscriber: Callable[[dict], None]) -> None:
+        with self.lock:
+            self.subscribers = self.subscribers + [ subscriber ]
+
+    def unsubscribe(self, subscriber: Callable[[dict], None]) -> None:
+        with self.lock:
+            self.subscribers = [ s for s in self.subscribers if s != subscriber ]
+
+    def publish(self, device: str, kind: str, /, **fields) -> None:
+        # the list is replaced, never modified, so no lock is needed here
+        subscribers = self.subscribers
+        if not subscribers:
+            return
+        event = dict(fields, device=device, kind=kind, time=time.monotonic())
+        for subscriber in subscribers:
+            try:
+                subscriber(event)
+            except Exception as error:
+                self.logger.debug("event subscriber failed: %s", error)
+
+# the process-wide bus
+_bus = EventBus()
+
+def get_event_bus() -> EventBus:
+    return _bus
+
+### end of file ###
@@ -0,0 +1,131 @@
+##############################################################################
+#
+# Name: governor.py
+#
+# Function:
+#       ResourceGovernor() class: process-wide caps on sockets, ssh
+#       transports, worker threads and buffered image bytes.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import concurrent.futures
+import contextlib
+import logging as Logging
+import threading
+import typing
+
+Any = typing.Any
+Union = typing.Union
+
+from .constants import Constants
+
+##############################################################################
+#
+# The resource governor
+#
+##############################################################################
+
+class ResourceGovernor():
+    """
+    Counting limits on shared resources. Work that would go over a
+    limit waits until something is released, rather than failing with
+    EMFILE or running out of memory. The resources are:
+
+        "sockets"       HTTP requests to the commissioning API
+        "ssh"           open ssh connections (each has a socket and a thread)
+        "image_bytes"   image data buffered for uploads
+
+    A request for more than the whole limit is trimmed to the limit, so
+    it runs alone rather than never. Worker threads aren't counted here:
+    max_threads caps the size of each worker_pool() instead.
+    """
+    DEFAULT_LIMITS = {
+        "sockets": Constants.DEFAULT_MAX_SOCKETS,
+        "ssh": Constants.DEFAULT_MAX_SSH,
+        "image_bytes": Constants.DEFAULT_MAX_IMAGE_MEMORY,
+    }
+
+    def __init__(self, /, limits: Union[typing.Dict[str, int], None] = None):
+        self.condition = threading.Condition()
+        self.max_threads = Constants.DEFAULT_MAX_THREADS
+        self.limits = dict(self.DEFAULT_LIMITS)
+        self.used = { name: 0 for name in self.limits }
+        self.peak = { name: 0 for name in self.limits }
+        self.waits = { name: 0 for name in self.limits }
+        self.logger = Logging.getLogger(__name__)
+        if limits != None:
+            self.configure(limits)
+        pass
+
+    def configure(self, limits: typing.Dict[str, int], /, max_threads: Union[int, None] = None) -> None:
+        """ change limits (and the pool size cap); None values are ignored """
+        with self.condition:
+            if max_threads != None:
+                self.max_threads = max(1, int(max_threads))
+            for name, limit in limits.items():
+                if limit == None:
+                    continue
+                if name not in self.limits:
+                    raise ValueError(f"unknown resource: {name}")
+                self.limits[name] = max(1, int(limit))
+            self.condition.notify_all()
+
+    def limit(self, name: str) -> int:
+        return self.limits[name]
+
+    def acquire(self, name: str, /, amount: int = 1) -> int:
+        """ wait for amount of resource name; returns what was granted """
+        with self.condition:
+            amount = min(amount, self.limits[name])
+            if self.used[name] + amount > self.limits[name]:
+                self.waits[name] += 1
+                self.logger.debug("waiting for %s (%d in use)", name, self.used[name])
+                self.condition.wait_for(lambda: self.used[name] + amount <= self.limits[name])
+            self.used[name] += amount
+            self.peak[name] = max(self.peak[name], self.used[name])
+            return amount
+
+    def release(self, name: str, /, amount: int = 1) -> None:
+        with self.condition:
+            self.used[name] -= amount
+            self.condition.notify_all()
+
+    @contextlib.contextmanager
+    def hold(self, name: str, /, amount: int = 1) -> typing.Iterator[int]:
+        granted = self.acquire(name, amount=amount)
+        try:
+            yield granted
+        finally:
+            self.release(name, amount=granted)
+
+    def worker_pool(self, workers: int) -> concurrent.futures.ThreadPoolExecutor:
+        """ a pool for running devices, no bigger than max_threads """
+        return concurrent.futures.ThreadPoolExecutor(max_workers=max(1, min(workers, self.max_threads)))
+
+    def stats(self) -> dict:
+        with self.condition:
+            return {
+                name: {
+                    "limit": self.limits[name],
+                    "used": self.used[name],
+                    "peak": self.peak[name],
+                    "waits": self.waits[name],
+                }
+                for name in self.limits
+            }
+
+# the process-wide governor
+_governor = ResourceGovernor()
+
+def get_governor() -> ResourceGovernor:
+    return _governor
+
+### end of file ###
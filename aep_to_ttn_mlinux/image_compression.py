@@ -0,0 +1,207 @@
+##############################################################################
+#
+# Name: image_compression.py
+#
+# Function:
+#       ImageCompression() class: decide whether (and how) to compress an
+#       image for upload, based on a measured compression ratio.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import hashlib
+import json
+import logging as Logging
+import os
+import pathlib
+import threading
+import typing
+import zlib
+
+Any = typing.Any
+Union = typing.Union
+
+# zstd is optional; without it, we only offer gzip.
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .constants import Constants
+
+##############################################################################
+#
+# Image compression
+#
+##############################################################################
+
+class ImageCompression():
+    """
+    Choose a compression method for uploading an image.
+
+    The ratio (compressed size / raw size) for each method is measured
+    once per image, and cached by the image's hash. A method is only
+    used if the Conduit can decompress it and it gets the upload below
+    COMPRESSION_MAX_RATIO of the raw size. Images that are already
+    compressed (by magic number) are never compressed again.
+    """
+
+    # in order of preference, for equal ratios
+    METHODS = ("zstd", "gzip")
+
+    # what the Conduit runs to decompress stdin to stdout
+    DECOMPRESS_COMMAND = {
+        "gzip": "gunzip -c",
+        "zstd": "zstd -d -c",
+    }
+
+    # magic numbers of compressed formats: gzip, zstd, xz, bzip2
+    COMPRESSED_MAGIC = (b"\x1f\x8b", b"\x28\xb5\x2f\xfd", b"\xfd7zXZ\x00", b"BZh")
+
+    CHUNK_SIZE = 256 * 1024
+
+    # shared, since each device's App has its own instance
+    lock = threading.Lock()
+
+    # MD5 of each image by (path, size, mtime), so a batch hashes each
+    # image once; its own lock, so hashing doesn't hold up the ratios
+    digests: typing.Dict[typing.Tuple[str, int, int], str] = {}
+    digest_lock = threading.Lock()
+
+    def __init__(self, cache_path: str):
+        self.path = pathlib.Path(cache_path).expanduser()
+        self.logger = Logging.getLogger(__name__)
+        pass
+
+    @staticmethod
+    def local_methods() -> typing.Tuple[str, ...]:
+        """ the methods we can compress with """
+        return tuple(method for method in ImageCompression.METHODS if method != "zstd" or zstandard != None)
+
+    @staticmethod
+    def compressor(method: str) -> Any:
+        """ return a new streaming compressor (with compress() and flush()) """
+        if method == "gzip":
+            # wbits 31: deflate with a gzip header and trailer
+            return zlib.compressobj(6, zlib.DEFLATED, 31)
+        if method == "zstd" and zstandard != None:
+            return zstandard.ZstdCompressor(level=3).compressobj()
+        raise ValueError(f"unsupported compression method: {method}")
+
+    @classmethod
+    def compressed_chunks(cls, path: pathlib.Path, method: str) -> typing.Iterator[bytes]:
+        """ yield the compressed contents of path, a chunk at a time """
+        compressor = cls.compressor(method)
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(cls.CHUNK_SIZE), b""):
+                data = compressor.compress(chunk)
+                if data:
+                    yield data
+        data = compressor.flush()
+        if data:
+            yield data
+
+    @classmethod
+    def image_md5(cls, path: pathlib.Path) -> str:
+        """ return the MD5 of path, hashing it once per process while it's unchanged """
+        stat = path.stat()
+        key = (str(path.resolve()), stat.st_size, stat.st_mtime_ns)
+        with cls.digest_lock:
+            digest = cls.digests.get(key)
+            if digest == None:
+                md5 = hashlib.md5()
+                with open(path, "rb") as f:
+                    for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                        md5.update(chunk)
+                digest = cls.digests[key] = md5.hexdigest()
+        return digest
+
+    @classmethod
+    def is_compressed(cls, path: pathlib.Path) -> bool:
+        with open(path, "rb") as f:
+            head = f.read(8)
+        return any(head.startswith(magic) for magic in cls.COMPRESSED_MAGIC)
+
+    #### the ratio cache
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            self.logger.warning("can't read compression cache %s: %s", self.path, error)
+            return {}
+
+    def _save(self, cache: dict) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(cache, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def ratios(self, path: pathlib.Path, image_hash: str) -> typing.Dict[str, float]:
+        """ return the compression ratio of each local method, measuring if needed """
+        with self.lock:
+            cache = self._load()
+            entry = cache.get(image_hash, {})
+            missing = [ method for method in self.local_methods() if method not in entry ]
+            if not missing:
+                return entry
+
+            size = path.stat().st_size
+            for method in missing:
+                nBytes = sum(len(chunk) for chunk in self.compressed_chunks(path, method))
+                entry[method] = nBytes / size if size > 0 else 1.0
+                self.logger.info("%s: %s compression ratio %.3f", path.name, method, entry[method])
+
+            cache[image_hash] = entry
+            self._save(cache)
+            return entry
+
+    def choose(
+        self,
+        path: pathlib.Path,
+        image_hash: str,
+        remote_methods: typing.Iterable[str],
+        /,
+        requested: str = "auto"
+        ) -> Union[str, None]:
+        """
+        Return the method to upload path with, or None for a raw upload.
+        requested is "auto", "raw", or a method name (which is used if
+        both sides support it).
+        """
+        logger = self.logger
+        remote_methods = set(remote_methods)
+        usable = [ method for method in self.local_methods() if method in remote_methods ]
+
+        if requested == "raw":
+            return None
+        if requested != "auto":
+            if requested in usable:
+                return requested
+            logger.warning("can't use %s compression here, uploading raw", requested)
+            return None
+
+        if not usable:
+            return None
+        if self.is_compressed(path):
+            logger.info("%s is already compressed", path.name)
+            return None
+
+        ratios = self.ratios(path, image_hash)
+        method = min(usable, key=lambda method: ratios[method])
+        if ratios[method] > Constants.COMPRESSION_MAX_RATIO:
+            logger.info("%s doesn't compress well (%.3f), uploading raw", path.name, ratios[method])
+            return None
+        return method
+
+### end of file ###
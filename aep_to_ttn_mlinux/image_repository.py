@@ -0,0 +1,309 @@
+##############################################################################
+#
+# Name: image_repository.py
+#
+# Function:
+#       ImageRepository() class: a local store of mLinux images, fetched
+#       from a web server by product type and version.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import concurrent.futures
+import hashlib
+import json
+import logging as Logging
+import os
+import pathlib
+import threading
+import time
+import typing
+import requests
+
+Any = typing.Any
+Union = typing.Union
+
+from .constants import Constants
+
+##############################################################################
+#
+# The image repository
+#
+##############################################################################
+
+class ImageRepository():
+    """
+    A directory of mLinux images, laid out as {product_type}/{version}/,
+    with an index.json recording where each image came from, its
+    validators (ETag and Last-Modified), its SHA-256, and when it was
+    last used.
+
+    Images are fetched with conditional requests, so refreshing an
+    unchanged image costs one round trip. If the server publishes a
+    checksum next to the image (the same URL plus ".sha256"), the
+    download is checked against it. For each product type, only the
+    most recently used 'keep' versions are kept.
+    """
+    INDEX = "index.json"
+    CHUNK_SIZE = 1024 * 1024
+
+    # shared, since each device's App has its own instance
+    lock = threading.Lock()
+
+    # (path, size, mtime) of images whose SHA-256 has been checked
+    # against the index in this process, so a batch hashes each once
+    verified: typing.Set[typing.Tuple[str, int, int]] = set()
+
+    class Error(Exception):
+        """ this is the Exception thrown for image repository errors """
+        pass
+
+    def __init__(
+        self,
+        root: str,
+        /,
+        base_url: str = Constants.DEFAULT_IMAGE_BASE_URL,
+        keep: int = Constants.DEFAULT_IMAGE_KEEP
+        ):
+        self.root = pathlib.Path(root).expanduser()
+        self.base_url = base_url.rstrip("/")
+        self.keep = keep
+        self.logger = Logging.getLogger(__name__)
+        pass
+
+    @staticmethod
+    def key(product_type: str, version: str) -> str:
+        return f"{product_type}/{version}"
+
+    def url(self, product_type: str, version: str) -> str:
+        return Constants.IMAGE_URL_PATTERN.format(
+                    base_url=self.base_url,
+                    product_type=product_type,
+                    version=version
+                    )
+
+    #### the index (callers hold self.lock)
+    def _load_index(self) -> dict:
+        try:
+            with open(self.root / self.INDEX, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            self.logger.warning("can't read image index, starting over: %s", error)
+            return {}
+
+    def _save_index(self, index: dict) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        tmp = self.root / f"{self.INDEX}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.root / self.INDEX)
+
+    def _evict(self, index: dict, product_type: str) -> None:
+        """ drop the least recently used versions of product_type """
+        entries = sorted(
+                    (entry for entry in index.values() if entry["product_type"] == product_type),
+                    key=lambda entry: entry["last_used"],
+                    reverse=True
+                    )
+        for entry in entries[self.keep:]:
+            self.logger.info("evict image %s", self.key(product_type, entry["version"]))
+            path = self.root / entry["path"]
+            path.unlink(missing_ok=True)
+            try:
+                path.parent.rmdir()
+            except OSError:
+                pass
+            del index[self.key(product_type, entry["version"])]
+
+    #### fetching
+    def _get_checksum(self, session: requests.Session, url: str) -> Union[str, None]:
+        """ get the published SHA-256 for url, or None if there isn't one """
+        response = session.get(f"{url}.sha256", timeout=Constants.IMAGE_FETCH_TIMEOUT)
+        if response.status_code == 404:
+            return None
+        response.raise_for_status()
+        fields = response.text.split()
+        if len(fields) == 0:
+            return None
+        return fields[0].casefold()
+
+    def fetch(self, product_type: str, version: str, /, session: Union[requests.Session, None] = None) -> pathlib.Path:
+        """
+        Make sure the image for product_type and version is present and
+        current, and return its path. Raises ImageRepository.Error on
+        failure.
+        """
+        logger = self.logger
+        key = self.key(product_type, version)
+        url = self.url(product_type, version)
+        if session == None:
+            session = requests.Session()
+
+        with self.lock:
+            entry = self._load_index().get(key)
+
+        headers = {}
+        if entry != None and (self.root / entry["path"]).exists():
+            if entry.get("etag"):
+                headers["If-None-Match"] = entry["etag"]
+            if entry.get("last_modified"):
+                headers["If-Modified-Since"] = entry["last_modified"]
+        else:
+            entry = None
+
+        try:
+            logger.info("fetch image %s: GET %s", key, url)
+            with session.get(url, headers=headers, stream=True, timeout=Constants.IMAGE_FETCH_TIMEOUT) as response:
+                if response.status_code == 304 and entry != None:
+                    logger.info("image %s is up to date", key)
+                    with self.lock:
+                        index = self._load_index()
+                        if key in index:
+                            index[key]["last_used"] = time.time()
+                            self._save_index(index)
+                    return self.root / entry["path"]
+
+                response.raise_for_status()
+                if response.status_code != 200:
+                    raise self.Error(f"can't fetch image {key}: unexpected status {response.status_code}")
+
+                path = pathlib.PurePosixPath(product_type, version, url.rpartition("/")[2])
+                target = self.root / path
+                target.parent.mkdir(parents=True, exist_ok=True)
+                tmp = target.with_name(f"{target.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+                digest = hashlib.sha256()
+                nBytes = 0
+                try:
+                    with open(tmp, "wb") as f:
+                        for chunk in response.iter_content(chunk_size=self.CHUNK_SIZE):
+                            f.write(chunk)
+                            digest.update(chunk)
+                            nBytes += len(chunk)
+
+                    sha256 = digest.hexdigest()
+                    expected = self._get_checksum(session, url)
+                    if expected == None:
+                        logger.warning("no published checksum for image %s", key)
+                    elif expected != sha256:
+                        raise self.Error(f"checksum mismatch for image {key}: {sha256} != {expected}")
+
+                    os.replace(tmp, target)
+                finally:
+                    tmp.unlink(missing_ok=True)
+
+                newEntry = {
+                    "product_type": product_type,
+                    "version": version,
+                    "url": url,
+                    "path": str(path),
+                    "size": nBytes,
+                    "sha256": sha256,
+                    "etag": response.headers.get("ETag"),
+                    "last_modified": response.headers.get("Last-Modified"),
+                    "fetched": time.time(),
+                    "last_used": time.time(),
+                }
+        except requests.exceptions.RequestException as error:
+            raise self.Error(f"can't fetch image {key}: {error}") from error
+        except OSError as error:
+            raise self.Error(f"can't store image {key}: {error}") from error
+
+        try:
+            with self.lock:
+                index = self._load_index()
+                index[key] = newEntry
+                self._evict(index, product_type)
+                self._save_index(index)
+        except OSError as error:
+            raise self.Error(f"can't update the image index for {key}: {error}") from error
+
+        logger.info("fetched image %s: %d bytes, sha256 %s", key, nBytes, sha256)
+        return target
+
+    def fetch_all(self, product_types: typing.Iterable[str], version: str, /, jobs: int = 4) -> bool:
+        """ fetch images for several product types concurrently """
+        logger = self.logger
+        product_types = list(dict.fromkeys(product_types))
+        result = True
+
+        def fetch_one(product_type: str) -> pathlib.Path:
+            # sessions aren't safe to share between threads
+            with requests.Session() as session:
+                return self.fetch(product_type, version, session=session)
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            futures = { executor.submit(fetch_one, product_type): product_type for product_type in product_types }
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    path = future.result()
+                    logger.info("image for %s: %s", futures[future], path)
+                except self.Error as error:
+                    logger.error("%s", error)
+                    result = False
+
+        return result
+
+    #### lookup
+    @staticmethod
+    def _file_sha256(path: pathlib.Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(ImageRepository.CHUNK_SIZE), b""):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def _intact(self, path: pathlib.Path, entry: dict) -> bool:
+        """ check size and SHA-256 against the index (hashing once per process) """
+        try:
+            stat = path.stat()
+        except OSError:
+            return False
+        if stat.st_size != entry["size"]:
+            return False
+        signature = (str(path), stat.st_size, stat.st_mtime_ns)
+        if signature in self.verified:
+            return True
+        if self._file_sha256(path) != entry["sha256"]:
+            return False
+        self.verified.add(signature)
+        return True
+
+    def resolve(self, product_type: str, version: str, /, touch: bool = True) -> Union[pathlib.Path, None]:
+        """
+        Return the path of a local image for product_type and version,
+        or None if we don't have it or it's damaged. Unless touch is
+        False (e.g., for a dry run), marks the image as used.
+        """
+        key = self.key(product_type, version)
+        with self.lock:
+            index = self._load_index()
+            entry = index.get(key)
+            if entry == None:
+                return None
+            path = self.root / entry["path"]
+            try:
+                intact = self._intact(path, entry)
+            except OSError as error:
+                self.logger.warning("can't check image %s: %s", key, error)
+                return None
+            if not intact:
+                self.logger.warning("image %s is missing or damaged", key)
+                return None
+            if touch:
+                entry["last_used"] = time.time()
+                try:
+                    self._save_index(index)
+                except OSError as error:
+                    self.logger.warning("can't update the image index: %s", error)
+        return path
+
+### end of file ###
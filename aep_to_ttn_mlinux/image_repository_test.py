@@ -0,0 +1,247 @@
+##############################################################################
+#
+# Name: image_repository_test.py
+#
+# Function:
+#       Run the image repository against a local HTTP server standing in
+#       for the image site: fetch, conditional refresh, checksums,
+#       eviction, and concurrent use from several instances.
+#
+#       python -m aep_to_ttn_mlinux.image_repository_test
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import functools
+import hashlib
+import http.server
+import json
+import logging as Logging
+import pathlib
+import sys
+import tempfile
+import threading
+import time
+import typing
+
+Any = typing.Any
+
+from .constants import Constants
+from .image_repository import ImageRepository
+
+##############################################################################
+#
+# The stand-in image site
+#
+##############################################################################
+
+class ImageSite():
+    """
+    A directory served over HTTP on the loopback interface, laid out
+    like the real image site. http.server answers If-Modified-Since with
+    304, which is what a conditional refresh relies on. Every request is
+    recorded as (path, status).
+    """
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self.requests: typing.List[typing.Tuple[str, int]] = []
+        site = self
+
+        class Handler(http.server.SimpleHTTPRequestHandler):
+            def log_request(self, code="-", size="-"):
+                site.requests.append((self.path, int(code)))
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), functools.partial(Handler, directory=str(root)))
+        self.server.daemon_threads = True
+        self.thread = threading.Thread(target=self.server.serve_forever, name="image-site", daemon=True)
+        pass
+
+    @property
+    def base_url(self) -> str:
+        return "http://{}:{}".format(*self.server.server_address[0:2])
+
+    def publish(self, product_type: str, version: str, data: bytes, /, checksum: typing.Union[str, None] = "") -> pathlib.Path:
+        """ add an image; checksum "" publishes the right one, None none at all """
+        url = Constants.IMAGE_URL_PATTERN.format(base_url="", product_type=product_type, version=version)
+        path = self.root / url.lstrip("/")
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+        if checksum == "":
+            checksum = hashlib.sha256(data).hexdigest()
+        if checksum != None:
+            path.with_name(path.name + ".sha256").write_text(f"{checksum}  {path.name}\n")
+        return path
+
+    def statuses(self, suffix: str) -> typing.List[int]:
+        return [ code for path, code in self.requests if path.endswith(suffix) ]
+
+    def __enter__(self) -> "ImageSite":
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+##############################################################################
+#
+# The test
+#
+##############################################################################
+
+class ImageRepositoryTest():
+    """
+    Each check runs against a fresh site and repository. Passes if all
+    of them do.
+    """
+    VERSION = "5.3.31"
+    THREADS = 8
+    ROUNDS = 20
+
+    def __init__(self):
+        self.failures = []
+        pass
+
+    def check(self, ok: bool, what: str) -> None:
+        print(f"{'ok' if ok else 'FAILED'}: {what}")
+        if not ok:
+            self.failures.append(what)
+
+    def _index(self, repository: ImageRepository) -> dict:
+        with open(repository.root / ImageRepository.INDEX, "r") as f:
+            return json.load(f)
+
+    def test_fetch_and_revalidate(self, site: ImageSite, directory: pathlib.Path) -> None:
+        data = bytes(range(256)) * 1024
+        site.publish("mtcdt", self.VERSION, data)
+        repository = ImageRepository(directory / "images", base_url=site.base_url)
+
+        path = repository.fetch("mtcdt", self.VERSION)
+        self.check(path.read_bytes() == data, "fetch downloads the image")
+        entry = self._index(repository)[ImageRepository.key("mtcdt", self.VERSION)]
+        self.check(entry["sha256"] == hashlib.sha256(data).hexdigest() and entry["last_modified"] != None, "the index records the checksum and validators")
+
+        again = repository.fetch("mtcdt", self.VERSION)
+        self.check(again == path and site.statuses(".bin") == [ 200, 304 ], f"a refresh of an unchanged image gets a 304: {site.statuses('.bin')}")
+
+        before = entry["last_used"]
+        time.sleep(0.01)
+        self.check(repository.resolve("mtcdt", self.VERSION) == path, "resolve finds the fetched image")
+        self.check(self._index(repository)[ImageRepository.key("mtcdt", self.VERSION)]["last_used"] > before, "resolve marks the image as used")
+        self.check(repository.resolve("mtcap", self.VERSION) == None, "resolve returns None for an image we don't have")
+
+    def test_checksum_mismatch(self, site: ImageSite, directory: pathlib.Path) -> None:
+        site.publish("mtcdt", self.VERSION, b"image", checksum="0" * 64)
+        repository = ImageRepository(directory / "images", base_url=site.base_url)
+        try:
+            repository.fetch("mtcdt", self.VERSION)
+            self.check(False, "a checksum mismatch is an error")
+        except ImageRepository.Error:
+            self.check(True, "a checksum mismatch is an error")
+        self.check(not any(repository.root.rglob("*.bin*")), "a bad download leaves nothing behind")
+
+    def test_eviction(self, site: ImageSite, directory: pathlib.Path) -> None:
+        versions = [ "5.3.1", "5.3.2", "5.3.3" ]
+        for version in versions:
+            site.publish("mtcdt", version, version.encode("utf-8"))
+        repository = ImageRepository(directory / "images", base_url=site.base_url, keep=2)
+        paths = [ repository.fetch("mtcdt", version) for version in versions ]
+        self.check(
+            not paths[0].exists() and paths[1].exists() and paths[2].exists(),
+            "only the 'keep' most recently used versions are kept"
+            )
+        self.check(sorted(self._index(repository).keys()) == [ ImageRepository.key("mtcdt", v) for v in versions[1:] ], "the index drops evicted versions")
+
+    def test_concurrent_use(self, site: ImageSite, directory: pathlib.Path) -> None:
+        product_types = [ "mtcdt", "mtcap" ]
+        for product_type in product_types:
+            site.publish(product_type, self.VERSION, product_type.encode("utf-8"))
+        repository = ImageRepository(directory / "images", base_url=site.base_url)
+        self.check(repository.fetch_all(product_types, self.VERSION, jobs=len(product_types)), "fetch_all fetches several product types at once")
+
+        # like a wave: every device's App has its own instance. A lost
+        # update leaves last_used older than the last resolve's start.
+        started = { product_type: 0.0 for product_type in product_types }
+        started_lock = threading.Lock()
+        def use(product_type: str) -> None:
+            mine = ImageRepository(directory / "images", base_url=site.base_url)
+            for _ in range(self.ROUNDS):
+                with started_lock:
+                    started[product_type] = max(started[product_type], time.time())
+                mine.resolve(product_type, self.VERSION)
+        threads = [
+            threading.Thread(target=use, args=(product_types[i % len(product_types)],))
+            for i in range(self.THREADS)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        index = self._index(repository)
+        self.check(
+            all(index[ImageRepository.key(product_type, self.VERSION)]["last_used"] >= started[product_type] for product_type in product_types),
+            "concurrent resolves from several instances don't lose updates"
+            )
+
+    def test_damage_and_errors(self, site: ImageSite, directory: pathlib.Path) -> None:
+        data = b"image" * 1024
+        site.publish("mtcdt", self.VERSION, data)
+        repository = ImageRepository(directory / "images", base_url=site.base_url)
+        path = repository.fetch("mtcdt", self.VERSION)
+
+        before = (repository.root / ImageRepository.INDEX).read_bytes()
+        time.sleep(0.01)
+        self.check(repository.resolve("mtcdt", self.VERSION, touch=False) == path, "resolve finds the image without touching it")
+        self.check((repository.root / ImageRepository.INDEX).read_bytes() == before, "resolve without touch leaves the index alone")
+
+        # same size, different contents
+        path.write_bytes(b"IMAGE" * 1024)
+        self.check(repository.resolve("mtcdt", self.VERSION) == None, "resolve rejects an image that fails its checksum")
+
+        blocker = directory / "not-a-directory"
+        blocker.write_text("")
+        try:
+            ImageRepository(blocker / "images", base_url=site.base_url).fetch("mtcdt", self.VERSION)
+            self.check(False, "a filesystem error while fetching is an ImageRepository.Error")
+        except ImageRepository.Error:
+            self.check(True, "a filesystem error while fetching is an ImageRepository.Error")
+
+    def run(self) -> int:
+        Logging.basicConfig(level=Logging.ERROR)
+        for test in (self.test_fetch_and_revalidate, self.test_checksum_mismatch, self.test_eviction, self.test_concurrent_use,
+                     self.test_damage_and_errors):
+            with tempfile.TemporaryDirectory() as directory:
+                directory = pathlib.Path(directory)
+                with ImageSite(directory / "site") as site:
+                    try:
+                        test(site, directory)
+                    except Exception as error:
+                        self.check(False, f"{test.__name__} raised {error!r}")
+
+        print("PASS" if not self.failures else "FAIL")
+        return 0 if not self.failures else 1
+
+##############################################################################
+#
+# The main program
+#
+##############################################################################
+
+def main() -> int:
+    return ImageRepositoryTest().run()
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+### end of file ###
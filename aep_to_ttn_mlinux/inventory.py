@@ -0,0 +1,104 @@
+##############################################################################
+#
+# Name: inventory.py
+#
+# Function:
+#       Read an inventory of gateways, and make per-device options from
+#       it.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import argparse
+import json
+import typing
+
+Any = typing.Any
+Union = typing.Union
+
+##############################################################################
+#
+# The inventory
+#
+##############################################################################
+
+class Inventory():
+    """
+    An inventory is a JSON file listing the gateways to configure:
+
+        {
+            "devices": [
+                { "name": "gw-01", "address": "192.168.2.1", "station": "bench-a" },
+                { "name": "gw-02", "address": "192.168.3.1", "product_type": "mtcap" }
+            ]
+        }
+
+    Each device needs a unique "name" and an "address". "station" says
+    which station (agent) the gateway is attached to; devices without
+    one can be handled by any station. Any of the keys in DEVICE_OPTIONS
+    override the corresponding command-line option for that device.
+    """
+
+    # inventory keys, and the options they set
+    DEVICE_OPTIONS = {
+        "address": "address",
+        "name": "device_name",
+        "username": "username",
+        "password": "password",
+        "product_type": "product_type",
+        "product_id": "product_id",
+        "image": "image_file",
+        "image_version": "image_version",
+        "force": "force",
+        "skip_password": "nopass",
+    }
+
+    class Error(Exception):
+        """ this is the Exception thrown for inventory errors """
+        pass
+
+    def __init__(self, devices: typing.List[typing.Dict]):
+        names = set()
+        for device in devices:
+            if not isinstance(device, dict) or "name" not in device or "address" not in device:
+                raise self.Error(f"each device needs a name and an address: {device}")
+            if device["name"] in names:
+                raise self.Error(f"duplicate device name: {device['name']}")
+            names.add(device["name"])
+        self.devices = devices
+
+    @classmethod
+    def load(cls, path: str) -> "Inventory":
+        try:
+            with open(path, "r") as f:
+                contents = json.load(f)
+        except (OSError, ValueError) as error:
+            raise cls.Error(f"can't read inventory {path}: {error}") from error
+
+        if isinstance(contents, dict):
+            contents = contents.get("devices")
+        if not isinstance(contents, list):
+            raise cls.Error(f"inventory {path} has no device list")
+        return cls(contents)
+
+    @classmethod
+    def device_options(cls, options: Any, device: dict) -> argparse.Namespace:
+        """
+        Return a copy of options, set up for device. Pass the options
+        as given on the command line: the App fills in the discovered
+        product type and ID, and those must not leak between devices.
+        """
+        result = argparse.Namespace(**vars(options))
+        for key, option in cls.DEVICE_OPTIONS.items():
+            if key in device:
+                setattr(result, option, device[key])
+        return result
+
+### end of file ###
@@ -0,0 +1,547 @@
+##############################################################################
+#
+# Name: scale_test.py
+#
+# Function:
+#       Run the app against a simulated farm of Conduits, and check that
+#       open files, threads and memory stay within the resource limits.
+#
+#       python -m aep_to_ttn_mlinux.scale_test --devices 1000
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import argparse
+import collections
+import copy
+import datetime
+import hashlib
+import http.server
+import json
+import logging as Logging
+import os
+import pathlib
+import random
+import re
+import resource
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import typing
+import urllib.parse
+import zlib
+
+Any = typing.Any
+Union = typing.Union
+
+import warnings
+with warnings.catch_warnings():
+   warnings.filterwarnings("ignore", message='.*cryptography')
+   import paramiko
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from .constants import Constants
+from .governor import get_governor
+
+##############################################################################
+#
+# The simulated Conduits (run in a separate process)
+#
+##############################################################################
+
+class GatewayFarm():
+    """
+    Many simulated Conduits, told apart by the loopback address the
+    client connected to (127.1.x.y). Each has just enough of the
+    commissioning API and of ssh for one run of the app: commissioning,
+    login, system and remoteAccess, revert/save/restart (with a
+    simulated reboot), and the ssh commands the app runs (ping, the
+    probe, a gunzip upload and the firmware update).
+    """
+    PRODUCT_ID = "MTCDT-L4N1-246A-915-US"
+    FIRMWARE = "5.3.0"
+
+    def __init__(self, devices: int, /, password: str, reboot_delay: float):
+        self.password = password
+        self.reboot_delay = reboot_delay
+        self.lock = threading.Lock()
+        self.devices = {
+            GatewayFarm.address(i): {
+                "commissioned": False,
+                "saved": { "ssh": { "enabled": False, "lan": False, "wan": False, "port": 22 } },
+                "pending": None,
+                "ssh": False,
+                "up_at": 0.0,
+                "image": None,
+                "upgraded": False,
+            }
+            for i in range(devices)
+        }
+        for device in self.devices.values():
+            device["pending"] = copy.deepcopy(device["saved"])
+        self.host_key = paramiko.ECDSAKey.generate()
+        pass
+
+    @staticmethod
+    def address(i: int) -> str:
+        return f"127.1.{i // 254}.{i % 254 + 1}"
+
+    def device(self, address: str) -> Union[dict, None]:
+        return self.devices.get(address)
+
+    def ssh_up(self, device: dict) -> bool:
+        with self.lock:
+            return device["ssh"] and time.monotonic() >= device["up_at"]
+
+    #### the commissioning API
+    def api(self, device: dict, method: str, path: str, query: dict, body: Any) -> typing.Tuple[int, dict]:
+        with self.lock:
+            if path == "/api/commissioning":
+                if device["commissioned"]:
+                    return 405, { "status": "fail", "error": "already commissioned" }
+                if method == "POST":
+                    device["aas_step"] = device.get("aas_step", 0) + 1
+                    if device["aas_step"] >= 3:
+                        device["commissioned"] = True
+                return 200, { "status": "success", "result": { "aasID": "sim" } }
+
+            if path == "/api/login":
+                if device["commissioned"] and query.get("password") == self.password:
+                    return 200, { "status": "success", "result": { "token": "sim-token" } }
+                return 401, { "status": "fail", "error": "bad login" }
+
+            if query.get("token") != "sim-token":
+                return 401, { "status": "fail", "error": "not logged in" }
+
+            if method == "GET" and path == "/api/system":
+                return 200, { "status": "success", "result": { "productId": self.PRODUCT_ID, "firmware": self.FIRMWARE } }
+            if method == "GET" and path == "/api/remoteAccess":
+                return 200, { "status": "success", "result": copy.deepcopy(device["pending"]) }
+            if method == "PUT" and path.startswith("/api/remoteAccess"):
+                target = device["pending"]
+                for key in path.split("/")[3:]:
+                    target = target.setdefault(key, {})
+                target.update(body)
+                return 200, { "status": "success" }
+            if method == "POST" and path == "/api/command/revert":
+                device["pending"] = copy.deepcopy(device["saved"])
+                return 200, { "status": "success" }
+            if method == "POST" and path == "/api/command/save":
+                device["saved"] = copy.deepcopy(device["pending"])
+                return 200, { "status": "success" }
+            if method == "POST" and path == "/api/command/restart":
+                device["ssh"] = device["saved"]["ssh"]["enabled"]
+                device["up_at"] = time.monotonic() + self.reboot_delay * random.uniform(0.75, 1.25)
+                return 200, { "status": "success" }
+        return 404, { "status": "fail", "error": f"no such API: {method} {path}" }
+
+    #### ssh commands
+    def probe(self, device: dict, script: str) -> str:
+        remote = Constants.REMOTE_FIRMWARE_PATH
+        image = device["image"]
+        results = {}
+        for name in re.findall(r"""'%s"(\w+)":\{"status\"""", script):
+            if name == "tmp_free":
+                result = (0, "tmpfs 262144 1024 261120 1% /tmp")
+            elif name == "image_md5":
+                result = (0, f"{image['md5']}  {remote}") if image else (1, "")
+            elif name == "image_size":
+                result = (0, str(image["size"])) if image else (1, "")
+            elif name == "firmware_version":
+                result = (0, self.FIRMWARE)
+            elif name in ("upgrade_tool", "has_gzip"):
+                result = (0, "")
+            else:
+                result = (1, "")
+            results[name] = { "status": result[0], "output": result[1] }
+        return json.dumps(results) + "\n"
+
+    def exec_command(self, device: dict, channel: paramiko.Channel, command: str) -> None:
+        status = 0
+        try:
+            if command == "echo ping":
+                channel.sendall(b"ping\n")
+            elif "_json()" in command:
+                channel.sendall(self.probe(device, command).encode("utf-8"))
+            elif command.startswith("gunzip -c >"):
+                decompressor = zlib.decompressobj(31)
+                md5 = hashlib.md5()
+                size = 0
+                for data in iter(lambda: channel.recv(256 * 1024), b""):
+                    data = decompressor.decompress(data)
+                    md5.update(data)
+                    size += len(data)
+                device["image"] = { "md5": md5.hexdigest(), "size": size }
+            elif command.startswith("sudo ") and Constants.FIRMWARE_UPGRADE_TOOL in command:
+                if device["image"] == None:
+                    channel.sendall_stderr(b"no image\n")
+                    status = 1
+                else:
+                    device["upgraded"] = True
+            else:
+                channel.sendall_stderr(f"sh: {command}: not found\n".encode("utf-8"))
+                status = 127
+        except Exception as error:
+            channel.sendall_stderr(f"{error}\n".encode("utf-8"))
+            status = 1
+        # the transport replies to the exec request after we return from
+        # check_channel_exec_request(), so this can overtake the reply.
+        # Data, status and EOF can arrive early; a close can't, so we
+        # leave that to the client.
+        channel.send_exit_status(status)
+        channel.shutdown_write()
+
+    #### servers
+    def _certificate(self, directory: pathlib.Path) -> ssl.SSLContext:
+        key = ec.generate_private_key(ec.SECP256R1())
+        name = x509.Name([ x509.NameAttribute(NameOID.COMMON_NAME, "conduit") ])
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cert = (
+            x509.CertificateBuilder()
+                .subject_name(name)
+                .issuer_name(name)
+                .public_key(key.public_key())
+                .serial_number(x509.random_serial_number())
+                .not_valid_before(now - datetime.timedelta(days=1))
+                .not_valid_after(now + datetime.timedelta(days=1))
+                .sign(key, hashes.SHA256())
+            )
+        keyfile = directory / "key.pem"
+        certfile = directory / "cert.pem"
+        keyfile.write_bytes(key.private_bytes(
+                serialization.Encoding.PEM,
+                serialization.PrivateFormat.PKCS8,
+                serialization.NoEncryption()
+                ))
+        certfile.write_bytes(cert.public_bytes(serialization.Encoding.PEM))
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(certfile, keyfile)
+        return context
+
+    def serve_api(self, context: ssl.SSLContext) -> http.server.ThreadingHTTPServer:
+        farm = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def _handle(self, method: str):
+                device = farm.device(self.connection.getsockname()[0])
+                url = urllib.parse.urlsplit(self.path)
+                query = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length", "0"))
+                body = json.loads(self.rfile.read(length)) if length > 0 else None
+                if device == None:
+                    code, reply = 404, { "status": "fail", "error": "no such device" }
+                else:
+                    code, reply = farm.api(device, method, url.path, query, body)
+                data = json.dumps(reply).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                self._handle("GET")
+
+            def do_POST(self):
+                self._handle("POST")
+
+            def do_PUT(self):
+                self._handle("PUT")
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(http.server.ThreadingHTTPServer):
+            request_queue_size = 1024
+            daemon_threads = True
+
+        server = Server(("0.0.0.0", 0), Handler)
+        # the handshake happens in the handler thread, on first read.
+        server.socket = context.wrap_socket(server.socket, server_side=True, do_handshake_on_connect=False)
+        threading.Thread(target=server.serve_forever, name="api", daemon=True).start()
+        return server
+
+    def _ssh_connection(self, sock: socket.socket) -> None:
+        farm = self
+        device = self.device(sock.getsockname()[0])
+        if device == None or not self.ssh_up(device):
+            # the Conduit is rebooting, or ssh isn't enabled
+            sock.close()
+            return
+
+        class Server(paramiko.ServerInterface):
+            def get_allowed_auths(self, username):
+                return "password"
+
+            def check_auth_password(self, username, password):
+                if password == farm.password:
+                    return paramiko.AUTH_SUCCESSFUL
+                return paramiko.AUTH_FAILED
+
+            def check_channel_request(self, kind, chanid):
+                if kind == "session":
+                    return paramiko.OPEN_SUCCEEDED
+                return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+            def check_channel_exec_request(self, channel, command):
+                threading.Thread(
+                    target=farm.exec_command,
+                    args=(device, channel, command.decode("utf-8")),
+                    daemon=True
+                    ).start()
+                return True
+
+        transport = paramiko.Transport(sock)
+        transport.add_server_key(self.host_key)
+        try:
+            transport.start_server(server=Server())
+        except (paramiko.SSHException, EOFError, OSError):
+            transport.close()
+
+    def serve_ssh(self) -> socket.socket:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(("0.0.0.0", 0))
+        listener.listen(1024)
+
+        def accept():
+            while True:
+                sock, _ = listener.accept()
+                threading.Thread(target=self._ssh_connection, args=(sock,), daemon=True).start()
+
+        threading.Thread(target=accept, name="ssh", daemon=True).start()
+        return listener
+
+    def run(self) -> None:
+        """ serve, print the ports on stdout, and run until stdin closes """
+        Logging.getLogger("paramiko").setLevel(Logging.CRITICAL)
+        with tempfile.TemporaryDirectory() as directory:
+            api = self.serve_api(self._certificate(pathlib.Path(directory)))
+            ssh = self.serve_ssh()
+            print(json.dumps({ "api_port": api.server_address[1], "ssh_port": ssh.getsockname()[1] }), flush=True)
+            sys.stdin.read()
+        upgraded = sum(1 for device in self.devices.values() if device["upgraded"])
+        print(json.dumps({ "upgraded": upgraded }), flush=True)
+
+##############################################################################
+#
+# The scale test (runs the app in this process)
+#
+##############################################################################
+
+class ScaleTest():
+    """
+    Start a GatewayFarm in a subprocess, run every simulated device
+    through App.run_inventory_device() in one process, and sample the
+    open files and threads while it runs. Passes if every device
+    succeeds and the peaks stay within budgets derived from the
+    resource limits:
+
+        files:      worker threads (one idle API socket each) + sockets
+                    (API requests, and the reboot watcher's probes) +
+                    ssh connections + open log files
+        threads:    worker threads + ssh connections times
+                    THREADS_PER_SSH (the transport, and the I/O threads
+                    of a running command)
+        memory:     --max-rss
+
+    plus whatever the process had open before the devices started.
+    Linux only (it reads /proc/self/fd).
+    """
+    THREADS_PER_SSH = 4
+    SLACK = 16
+
+    def __init__(self, options: Any):
+        self.options = options
+        self.samples = { "fds": 0, "threads": 0 }
+        self.thread_kinds = collections.Counter()
+        self.stopping = threading.Event()
+        pass
+
+    @staticmethod
+    def _parse_arguments() -> Any:
+        parser = argparse.ArgumentParser(
+            prog="aep_to_ttn_mlinux.scale_test",
+            description="Run the app against many simulated Conduits and check its resource use."
+            )
+        parser.add_argument("--devices", type=int, default=1000,
+                        help="Number of simulated Conduits (default %(default)s).")
+        parser.add_argument("--reboot-delay", dest="reboot_delay", type=float, default=10,
+                        help="Average simulated reboot time, in seconds (default %(default)s).")
+        parser.add_argument("--image-size", dest="image_size", type=int, default=1024,
+                        help="Size of the test image in KiB (default %(default)s).")
+        parser.add_argument("--max-rss", dest="max_rss", type=int, default=1024,
+                        help="Peak resident memory allowed, in megabytes (default %(default)s).")
+        parser.add_argument("--max-sockets", dest="max_sockets", type=int, default=Constants.DEFAULT_MAX_SOCKETS,
+                        help="Passed to the app (default %(default)s).")
+        parser.add_argument("--max-ssh", dest="max_ssh", type=int, default=Constants.DEFAULT_MAX_SSH,
+                        help="Passed to the app (default %(default)s).")
+        parser.add_argument("--max-threads", dest="max_threads", type=int, default=Constants.DEFAULT_MAX_THREADS,
+                        help="Passed to the app (default %(default)s).")
+        parser.add_argument("--max-image-memory", dest="max_image_memory", type=int,
+                        default=Constants.DEFAULT_MAX_IMAGE_MEMORY // (1024 * 1024),
+                        help="Passed to the app, in megabytes (default %(default)s).")
+        parser.add_argument("--wave", action="store_true",
+                        help="Run the devices as one wave (--wave), instead of one by one.")
+        parser.add_argument("--log-dir", dest="log_dir", default=None,
+                        help="Keep the per-device logs here (default: a temporary directory).")
+        parser.add_argument("--serve", action="store_true",
+                        help=argparse.SUPPRESS)
+        parser.add_argument("--password", default="scale-test-1",
+                        help=argparse.SUPPRESS)
+        return parser.parse_args()
+
+    @staticmethod
+    def _write_image(path: pathlib.Path, size: int) -> None:
+        # half random, half zeros: compresses about 2:1, like a real image
+        rng = random.Random(0)
+        with open(path, "wb") as f:
+            for _ in range(size):
+                f.write(rng.randbytes(512) + bytes(512))
+
+    def _monitor(self) -> None:
+        while not self.stopping.wait(0.05):
+            self.samples["fds"] = max(self.samples["fds"], len(os.listdir("/proc/self/fd")))
+            threads = threading.enumerate()
+            if len(threads) > self.samples["threads"]:
+                self.samples["threads"] = len(threads)
+                # what the threads were doing, by name without the number
+                self.thread_kinds = collections.Counter(re.sub(r"[-_ ]?\d+.*$", "", thread.name) for thread in threads)
+
+    def _start_farm(self) -> typing.Tuple[subprocess.Popen, dict]:
+        options = self.options
+        farm = subprocess.Popen(
+            [
+                sys.executable, "-m", "aep_to_ttn_mlinux.scale_test", "--serve",
+                "--devices", str(options.devices),
+                "--reboot-delay", str(options.reboot_delay),
+                "--password", options.password,
+            ],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            text=True
+            )
+        ports = json.loads(farm.stdout.readline())
+        return farm, ports
+
+    def run(self) -> int:
+        # imported here, so the farm process doesn't load the app.
+        from .app import App
+
+        options = self.options
+        with tempfile.TemporaryDirectory() as directory:
+            directory = pathlib.Path(directory)
+            image = directory / "mlinux-scale-test.bin"
+            self._write_image(image, options.image_size)
+
+            devices = [
+                { "name": f"gw{i:04d}", "address": GatewayFarm.address(i) }
+                for i in range(options.devices)
+            ]
+            inventory = directory / "inventory.json"
+            results = directory / "results.json"
+            with open(inventory, "w") as f:
+                json.dump({ "devices": devices }, f)
+
+            farm, ports = self._start_farm()
+            try:
+                app = App(argv=([ "--wave", str(inventory), "--results", str(results) ] if options.wave else []) + [
+                    "--password", options.password,
+                    "--api-port", str(ports["api_port"]),
+                    "--ssh-port", str(ports["ssh_port"]),
+                    "--image", str(image),
+                    "--compress", "gzip",
+                    "--compression-cache", str(directory / "compression.json"),
+                    "--image-repository", str(directory / "images"),
+                    "--no-ssh-profile",
+                    "--log-dir", options.log_dir if options.log_dir != None else str(directory / "logs"),
+                    "--max-sockets", str(options.max_sockets),
+                    "--max-ssh", str(options.max_ssh),
+                    "--max-threads", str(options.max_threads),
+                    "--max-image-memory", str(options.max_image_memory),
+                    ])
+
+                governor = get_governor()
+                base_fds = len(os.listdir("/proc/self/fd"))
+                base_threads = threading.active_count()
+                monitor = threading.Thread(target=self._monitor, name="monitor", daemon=True)
+                monitor.start()
+
+                begin = time.monotonic()
+                if options.wave:
+                    app.run()
+                    with open(results, "r") as f:
+                        statuses = [ job["status"] for job in json.load(f)["jobs"] ]
+                else:
+                    with governor.worker_pool(len(devices)) as pool:
+                        statuses = [ result["status"] for result in pool.map(app.run_inventory_device, devices) ]
+                elapsed = time.monotonic() - begin
+
+                self.stopping.set()
+                monitor.join()
+            finally:
+                farm.stdin.close()
+                farm.wait()
+            upgraded = json.loads(farm.stdout.readline() or "{}").get("upgraded")
+            farm.stdout.close()
+
+        limits = { name: governor.limit(name) for name in ("sockets", "ssh") }
+        limits["threads"] = governor.max_threads
+        budgets = {
+            "fds": base_fds + limits["threads"] + limits["sockets"] + limits["ssh"] + Constants.MAX_OPEN_LOG_FILES + self.SLACK,
+            "threads": base_threads + limits["threads"] + limits["ssh"] * self.THREADS_PER_SSH + self.SLACK,
+            "rss": options.max_rss,
+        }
+        peaks = dict(self.samples, rss=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024)
+        failed = [ device["name"] for device, status in zip(devices, statuses) if status != 0 ]
+
+        print(f"{len(devices)} devices in {elapsed:.1f} seconds: {len(devices) - len(failed)} succeeded, {len(failed)} failed, {upgraded} upgraded")
+        if failed:
+            print("failed:", ", ".join(failed[:20]) + (" ..." if len(failed) > 20 else ""))
+        ok = not failed and upgraded == len(devices)
+        for name, unit in (("fds", ""), ("threads", ""), ("rss", " MB")):
+            within = peaks[name] <= budgets[name]
+            ok = ok and within
+            print(f"peak {name}: {peaks[name]}{unit} (budget {budgets[name]}{unit}){'' if within else ' OVER BUDGET'}")
+            if name == "threads" and not within:
+                print("threads at the peak:", ", ".join(f"{kind} {n}" for kind, n in self.thread_kinds.most_common()))
+        for name, stats in governor.stats().items():
+            print(f"governor {name}: peak {stats['peak']} of {stats['limit']}, {stats['waits']} waits")
+
+        print("PASS" if ok else "FAIL")
+        return 0 if ok else 1
+
+##############################################################################
+#
+# The main program
+#
+##############################################################################
+
+def main() -> int:
+    options = ScaleTest._parse_arguments()
+    if options.serve:
+        GatewayFarm(options.devices, password=options.password, reboot_delay=options.reboot_delay).run()
+        return 0
+    return ScaleTest(options).run()
+
+if __name__ == '__main__':
+    sys.exit(main())
+
+### end of file ###
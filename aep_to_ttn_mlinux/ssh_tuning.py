@@ -0,0 +1,216 @@
+##############################################################################
+#
+# Name: ssh_tuning.py
+#
+# Function:
+#       SshProfileStore() and SshTuner() classes: benchmark ssh transport
+#       settings against a Conduit, and remember the fastest one for
+#       each product type and firmware version.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import io
+import json
+import logging as Logging
+import math
+import os
+import pathlib
+import threading
+import time
+import typing
+
+Any = typing.Any
+Union = typing.Union
+
+from .constants import Constants
+from .device_logging import device_name, get_logger
+from .conduit_ssh import ConduitSsh
+
+##############################################################################
+#
+# The profile store
+#
+##############################################################################
+
+class SshProfileStore():
+    """ a JSON file of tuned ssh profiles, keyed by product type and firmware """
+    def __init__(self, path: str):
+        self.path = pathlib.Path(path).expanduser()
+        self.logger = Logging.getLogger(__name__)
+        pass
+
+    @staticmethod
+    def key(product_type: str, firmware: str) -> str:
+        return f"{product_type}/{firmware}"
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as error:
+            self.logger.warning("can't read ssh profiles %s: %s", self.path, error)
+            return {}
+
+    def lookup(self, product_type: str, firmware: str) -> Union[typing.Dict, None]:
+        return self._load().get(self.key(product_type, firmware))
+
+    def store(self, product_type: str, firmware: str, profile: dict) -> None:
+        profiles = self._load()
+        profiles[self.key(product_type, firmware)] = profile
+
+        # write a new file and rename, so concurrent readers never
+        # see a partial file.
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "w") as f:
+            json.dump(profiles, f, indent=4, sort_keys=True)
+        os.replace(tmp, self.path)
+
+##############################################################################
+#
+# The tuner
+#
+##############################################################################
+
+class SshTuner():
+    """
+    Benchmark candidate ssh transport settings against a Conduit.
+
+    The search is greedy: first the cipher (which dominates upload time
+    on the ARM gateways), then the MAC, then the key exchange (which
+    only affects connect time), and finally compression. Each step keeps
+    the choices made so far. Candidates the device refuses are skipped.
+    """
+
+    # candidates, in the order we try them; anything paramiko doesn't
+    # support is dropped.
+    CANDIDATES = {
+        "cipher": (
+            "aes128-ctr",
+            "aes128-gcm@openssh.com",
+            "aes192-ctr",
+            "aes256-ctr",
+            "aes256-gcm@openssh.com",
+            "aes128-cbc",
+            "aes256-cbc",
+            ),
+        "mac": (
+            "hmac-sha2-256",
+            "hmac-sha2-256-etm@openssh.com",
+            "hmac-sha1",
+            "hmac-sha1-etm@openssh.com",
+            "hmac-md5",
+            "hmac-sha2-512",
+            ),
+        "kex": (
+            "curve25519-sha256@libssh.org",
+            "ecdh-sha2-nistp256",
+            "diffie-hellman-group14-sha256",
+            "diffie-hellman-group-exchange-sha256",
+            "diffie-hellman-group14-sha1",
+            ),
+    }
+
+    REMOTE_TUNE_FILE = "/tmp/tune-ssh.bin"
+
+    def __init__(self, options: Any, /, sample: bytes, rounds: int = Constants.DEFAULT_SSH_TUNE_ROUNDS):
+        self.options = options
+        self.sample = sample
+        self.rounds = rounds
+        self.logger = get_logger(__name__, device_name(options))
+        pass
+
+    @staticmethod
+    def get_sample(image_file: Union[pathlib.Path, None], nBytes: int = Constants.DEFAULT_SSH_TUNE_BYTES) -> bytes:
+        """
+        Return the data to upload for each trial. We prefer the start of
+        the real image, so compression is judged on realistic data.
+        """
+        if image_file != None and image_file.exists():
+            with open(image_file, "rb") as f:
+                sample = f.read(nBytes)
+            if len(sample) > 0:
+                return sample
+        return os.urandom(nBytes)
+
+    def measure(self, profile: dict) -> Union[typing.Dict, None]:
+        """
+        Time connect, one command, and an upload of the sample using
+        profile. Returns the best times over all rounds, or None if the
+        profile didn't work.
+        """
+        logger = self.logger
+        best = None
+        for _ in range(self.rounds):
+            ssh = ConduitSsh(self.options, profile=profile)
+            try:
+                with ssh.session() as c:
+                    t0 = time.perf_counter()
+                    c.open()
+                    t1 = time.perf_counter()
+                    c.run("true", hide=True, timeout=10)
+                    t2 = time.perf_counter()
+                    c.sftp().putfo(io.BytesIO(self.sample), self.REMOTE_TUNE_FILE)
+                    t3 = time.perf_counter()
+                    c.run(f"rm -f {self.REMOTE_TUNE_FILE}", hide=True, timeout=10)
+            except Exception as error:
+                logger.debug("ssh profile %s failed: %s", profile, error)
+                return None
+
+            result = {
+                "connect": t1 - t0,
+                "command": t2 - t1,
+                "upload": t3 - t2,
+            }
+            result["total"] = result["connect"] + result["command"] + result["upload"]
+            if best == None or result["total"] < best["total"]:
+                best = result
+
+        logger.info("ssh profile %s: %.2fs", profile, best["total"])
+        return best
+
+    def tune(self) -> Union[typing.Dict, None]:
+        """ find the fastest working profile; returns None if nothing works """
+        logger = self.logger
+
+        profile = {}
+        best = self.measure(profile)
+        if best == None:
+            logger.error("can't reach the Conduit with default ssh settings")
+            return None
+
+        for key, candidates in self.CANDIDATES.items():
+            available = ConduitSsh.available_algorithms(key)
+            for name in candidates:
+                if name not in available:
+                    continue
+                trial = dict(profile, **{key: name})
+                result = self.measure(trial)
+                if result != None and result["total"] < best["total"]:
+                    profile, best = trial, result
+
+        for compress in (True, False):
+            trial = dict(profile, compress=compress)
+            result = self.measure(trial)
+            if result != None and result["total"] < best["total"]:
+                profile, best = trial, result
+
+        # leave plenty of headroom over the measured connect time.
+        profile["timeout"] = max(Constants.DEFAULT_SSH_TIMEOUT, math.ceil(4 * best["connect"]))
+        profile["upload_rate"] = len(self.sample) / best["upload"]
+        profile["tuned"] = time.strftime("%Y-%m-%dT%H:%M:%S%z")
+
+        logger.info("best ssh profile: %s (%.0f bytes/s)", profile, profile["upload_rate"])
+        return profile
+
+### end of file ###
@@ -0,0 +1,200 @@
+##############################################################################
+#
+# Name: wave.py
+#
+# Function:
+#       RebootWatcher() class: watch a whole wave of rebooting Conduits
+#       from one thread, and report each one as it comes back.
+#
+# Copyright notice and license:
+#       See LICENSE.md
+#
+# Author:
+#       Terry Moore
+#
+##############################################################################
+
+#### imports ####
+from __future__ import print_function
+import errno
+import logging as Logging
+import selectors
+import socket
+import threading
+import time
+import typing
+
+Any = typing.Any
+Callable = typing.Callable
+Union = typing.Union
+
+from .constants import Constants
+from .governor import get_governor
+
+##############################################################################
+#
+# The reboot watcher
+#
+##############################################################################
+
+class RebootWatcher():
+    """
+    Watch many rebooting gateways at once. Every 'interval' seconds, one
+    thread opens a non-blocking connection to the ssh port of each
+    gateway still rebooting, and checks for an ssh banner. If ssh was
+    answering before the restart, a gateway is only back once it has
+    been seen down (no banner) and then up again, so an sshd that
+    hasn't stopped yet isn't mistaken for the rebooted one.
+
+    callback(key, ok) is called from the watcher's thread when a gateway
+    is back (ok is True) or its timeout runs out (ok is False), so it
+    must be quick; typically it submits the next step to a pool.
+    """
+    def __init__(
+        self,
+        /,
+        interval: float = Constants.REBOOT_WATCH_INTERVAL,
+        connect_timeout: float = Constants.DEFAULT_SSH_TIMEOUT
+        ):
+        self.interval = interval
+        self.connect_timeout = connect_timeout
+        self.lock = threading.Lock()
+        self.pending: typing.Dict[Any, typing.Dict] = {}
+        self.stopping = threading.Event()
+        self.thread = None
+        self.logger = Logging.getLogger(__name__)
+        pass
+
+    def watch(
+        self,
+        key: Any,
+        address: str,
+        port: int,
+        /,
+        timeout: float,
+        callback: Callable[[Any, bool], None],
+        was_up: bool = True
+        ) -> None:
+        """
+        start watching a gateway that has just been told to restart;
+        was_up says whether its ssh was answering before the restart.
+        """
+        with self.lock:
+            self.pending[key] = {
+                "address": address,
+                "port": port,
+                "deadline": time.monotonic() + timeout,
+                "down": not was_up,
+                "callback": callback,
+            }
+
+    def _probe(self, targets: typing.List[typing.Tuple[Any, str, int]]) -> typing.Set[Any]:
+        """ return the keys of the targets whose ssh port answers with a banner """
+        answering = set()
+        failures = { "connect": 0, "refused": 0, "no banner": 0 }
+        selector = selectors.DefaultSelector()
+        try:
+            for key, address, port in targets:
+                try:
+                    family, kind, proto, _, sockaddr = socket.getaddrinfo(address, port, type=socket.SOCK_STREAM)[0]
+                    sock = socket.socket(family, kind, proto)
+                except OSError:
+                    failures["connect"] += 1
+                    continue
+                sock.setblocking(False)
+                if sock.connect_ex(sockaddr) not in (0, errno.EINPROGRESS):
+                    failures["connect"] += 1
+                    sock.close()
+                    continue
+                selector.register(sock, selectors.EVENT_WRITE, key)
+
+            # first wait for the connection, then for the banner.
+            deadline = time.monotonic() + self.connect_timeout
+            while selector.get_map() and time.monotonic() < deadline:
+                for selected, events in selector.select(timeout=max(0, deadline - time.monotonic())):
+                    sock, key = selected.fileobj, selected.data
+                    if events & selectors.EVENT_WRITE:
+                        if sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) == 0:
+                            selector.modify(sock, selectors.EVENT_READ, key)
+                            continue
+                        failures["refused"] += 1
+                    else:
+                        try:
+                            if sock.recv(64).startswith(b"SSH-"):
+                                answering.add(key)
+                            else:
+                                failures["no banner"] += 1
+                        except OSError:
+                            failures["no banner"] += 1
+                    selector.unregister(sock)
+                    sock.close()
+        finally:
+            timed_out = len(selector.get_map())
+            for selected in list(selector.get_map().values()):
+                selected.fileobj.close()
+            selector.close()
+        self.logger.debug(
+            "probed %d: %d answering, %s, %d timed out",
+            len(targets), len(answering), ", ".join(f"{n} {kind}" for kind, n in failures.items()), timed_out
+            )
+        return answering
+
+    def answers(self, address: str, port: int) -> bool:
+        """ probe one gateway now: does its ssh port answer with a banner? """
+        with get_governor().hold("sockets"):
+            return address in self._probe([ (address, address, port) ])
+
+    def check(self) -> None:
+        """ probe every pending gateway once, and report the ones that are done """
+        with self.lock:
+            entries = list(self.pending.items())
+        if not entries:
+            return
+
+        # each probe is a socket; stay within the governor's limit, and
+        # leave room for the restart requests in flight meanwhile.
+        governor = get_governor()
+        batch = max(1, governor.limit("sockets") // 2)
+        answering = set()
+        for i in range(0, len(entries), batch):
+            targets = [ (key, entry["address"], entry["port"]) for key, entry in entries[i:i + batch] ]
+            with governor.hold("sockets", amount=len(targets)):
+                answering |= self._probe(targets)
+
+        now = time.monotonic()
+        finished = []
+        with self.lock:
+            for key, entry in entries:
+                if key not in answering:
+                    entry["down"] = True
+                elif entry["down"]:
+                    finished.append((key, entry, True))
+                    continue
+                if now > entry["deadline"]:
+                    finished.append((key, entry, False))
+            for key, _, _ in finished:
+                del self.pending[key]
+            remaining = len(self.pending)
+
+        if finished:
+            self.logger.info("%d gateway(s) back, %d still rebooting", sum(1 for _, _, ok in finished if ok), remaining)
+        for key, entry, ok in finished:
+            try:
+                entry["callback"](key, ok)
+            except Exception as error:
+                self.logger.error("reboot watcher callback failed", exc_info=error)
+
+    def _run(self) -> None:
+        while not self.stopping.wait(self.interval):
+            self.check()
+
+    def start(self) -> None:
+        self.thread = threading.Thread(target=self._run, name="reboot-watcher", daemon=True)
+        self.thread.start()
+
+    def stop(self) -> None:
+        self.stopping.set()
+        if self.thread != None:
+            self.thread.join()
+
+### end of file ###